@@ -0,0 +1,465 @@
+import os
+import json
+import lzma
+import shutil
+import hashlib
+import tempfile
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import change_detection
+from tool_runner import get_tool_runner
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+
+def volume_names(archive_path):
+    volumes = []
+    while os.path.exists(f"{archive_path}.{len(volumes) + 1:03d}"):
+        volumes.append(f"{archive_path}.{len(volumes) + 1:03d}")
+    return volumes
+
+
+def remove_volumes(archive_path):
+    for volume in [archive_path] + volume_names(archive_path):
+        if os.path.exists(volume):
+            os.remove(volume)
+
+
+def hash_volumes(volumes, algorithm):
+    hash_function = change_detection.new_hash(algorithm)
+    for volume in volumes:
+        with open(volume, "rb") as a_file:
+            for buf in iter(lambda: a_file.read(change_detection.block_size), b""):
+                hash_function.update(buf)
+    return change_detection.hash_value(algorithm, hash_function)
+
+
+class SevenZipArchiver:
+    """
+    7z.exe behind the archiver interface.
+
+    archive() gets the archive path without extention and a list of (file path, name)
+    members; all members of one archive have to be in one directory.
+    """
+    name = "7z"
+    extention = ".7z"
+    seven_zip_path = r"C:\Program Files\7-zip\7z.exe" if os.name == "nt" else "7z"
+    threads = 4
+    volume_size_mb = 1000
+
+    def __init__(self, seven_zip_path = None, threads = None, volume_size_mb = None) -> None:
+        if seven_zip_path:
+            self.seven_zip_path = seven_zip_path
+        if threads is not None:
+            self.threads = threads
+        if volume_size_mb is not None:
+            self.volume_size_mb = volume_size_mb
+
+    def available(self):
+        return shutil.which(str(self.seven_zip_path)) is not None
+
+    def settings(self, level):
+        return f"7z mx{level}"
+
+    def command(self, level, password):
+        cmd = [str(self.seven_zip_path), "a", "-t7z", f"-mx{level}", "-ms=on", f"-mmt={self.threads}", "-bso0", "-v%im" % self.volume_size_mb]
+        if password:
+            cmd.append("-p%s" % password)
+        return cmd
+
+    def run(self, cmd, **kwargs):
+        # exit code 1 is a warning (e.g. a file was locked), 2 and above - no usable archive
+        res = get_tool_runner().run_sync("7z", cmd, check=False, **kwargs)
+        if res.returncode >= 2:
+            raise RuntimeError("7z exit code %i: %s" % (res.returncode, res.stderr.decode(errors="replace").strip()))
+        return res
+
+    def archive(self, archive_path, members, level, password = None, hash_algorithm = None):
+        """
+        :return: volumes, archive size, archive hash, member hashes (None without hash_algorithm)
+        """
+        archive_path += self.extention
+        remove_volumes(archive_path)
+        cmd = self.command(level, password)
+        member_hashes = None
+
+        if len(members) == 1 and hash_algorithm:
+            # read the source once: every block is hashed and written to 7z stdin
+            file_path, name = members[0]
+            hash_function = change_detection.new_hash(hash_algorithm)
+            self.run(cmd + ["-si%s" % name, archive_path], input_file=file_path, on_input=hash_function.update)
+            member_hashes = [change_detection.hash_value(hash_algorithm, hash_function)]
+        elif len(members) == 1:
+            self.run(cmd + [archive_path, members[0][0]])
+        else:
+            with tempfile.TemporaryDirectory() as tmpdirname:
+                list_path = os.path.join(tmpdirname, "files.txt")
+                with open(list_path, "w", encoding="utf-8") as list_file:
+                    list_file.write("\n".join(os.path.basename(file_path) for file_path, name in members))
+                self.run(cmd + ["-scsUTF-8", archive_path, "@" + list_path], cwd=os.path.dirname(members[0][0]))
+            if hash_algorithm:
+                member_hashes = [change_detection.get_hash(file_path, hash_algorithm) for file_path, name in members]
+
+        volumes = volume_names(archive_path)
+        if not volumes:
+            raise RuntimeError(f"7z wrote no archive {archive_path}")
+        if len(volumes) == 1:
+            os.rename(volumes[0], archive_path)
+            volumes = [archive_path]
+        archive_size = sum(os.path.getsize(volume) for volume in volumes)
+        return volumes, archive_size, hash_volumes(volumes, hash_algorithm or "sha256"), member_hashes
+
+    def extract(self, volumes, output_directory, password = None, members = None):
+        cmd = [str(self.seven_zip_path), "x", "-y", "-bso0", f"-o{output_directory}", volumes[0]]
+        if password:
+            cmd.append("-p%s" % password)
+        get_tool_runner().run_sync("7z", cmd + list(members or []))
+
+
+class VolumeWriter:
+    """
+    File object writing archive_path.001, .002, ... of volume_size bytes and hashing
+    the archive while it is written.
+    """
+
+    def __init__(self, archive_path, volume_size, hash_function) -> None:
+        self.archive_path = archive_path
+        self.volume_size = volume_size
+        self.hash_function = hash_function
+        self.volumes = []
+        self.file = None
+        self.size = 0
+        self.volume_written = 0
+
+    def _next_volume(self):
+        if self.file is not None:
+            self.file.close()
+        self.volumes.append(f"{self.archive_path}.{len(self.volumes) + 1:03d}")
+        self.file = open(self.volumes[-1], "wb")
+        self.volume_written = 0
+
+    def write(self, data):
+        self.hash_function.update(data)
+        self.size += len(data)
+        view = memoryview(data)
+        while len(view):
+            if self.file is None or self.volume_written >= self.volume_size:
+                self._next_volume()
+            part = view[:self.volume_size - self.volume_written]
+            self.file.write(part)
+            self.volume_written += len(part)
+            view = view[len(part):]
+
+    def close(self):
+        if self.file is None:
+            self._next_volume()
+        self.file.close()
+        if len(self.volumes) == 1:
+            os.replace(self.volumes[0], self.archive_path)
+            self.volumes = [self.archive_path]
+        return self.volumes
+
+    def abort(self):
+        """
+        Close and remove the volumes written so far.
+        """
+        if self.file is not None:
+            self.file.close()
+        for volume in self.volumes:
+            if os.path.exists(volume):
+                os.remove(volume)
+
+
+class VolumeReader:
+    def __init__(self, volumes) -> None:
+        self.volumes = deque(volumes)
+        self.file = None
+
+    def read(self, size):
+        result = b""
+        while len(result) < size:
+            if self.file is None:
+                if not self.volumes:
+                    break
+                self.file = open(self.volumes.popleft(), "rb")
+            data = self.file.read(size - len(result))
+            if not data:
+                self.file.close()
+                self.file = None
+            result += data
+        return result
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class StreamArchiver:
+    """
+    In-process archiver; works wherever Python does.
+
+    Members are read once in chunk_size blocks; every block is hashed and the member
+    stream is compressed chunk by chunk (lzma, or zstd if zstandard is installed) in a
+    thread pool. With a password, member headers and chunks are encrypted with
+    AES-256-GCM (needs cryptography) with a scrypt key; the frame type, frame number and
+    archive header are authenticated, so reordered or truncated archives are rejected.
+
+    Layout: b"TCA1", then frames of type (1 byte), payload length (4 bytes) and payload:
+    "H" header JSON, "M" member JSON (name, size, mtime), "C" compressed chunk of the
+    concatenated member data, "Z" end with the total data length.
+    """
+    name = "stream"
+    extention = ".tca"
+    magic = b"TCA1"
+    threads = 4
+    volume_size_mb = 1000
+    chunk_size = 4 * 1024 * 1024
+
+    def __init__(self, threads = None, volume_size_mb = None, compression = None) -> None:
+        if threads is not None:
+            self.threads = threads
+        if volume_size_mb is not None:
+            self.volume_size_mb = volume_size_mb
+        self.compression = compression or ("zstd" if zstandard is not None else "lzma")
+
+    def available(self):
+        return True
+
+    def settings(self, level):
+        return f"stream {self.compression} {level}"
+
+    def _compressor(self, compression, level):
+        if compression == "zstd":
+            if zstandard is None:
+                raise RuntimeError("zstd archives need the zstandard module")
+            # a ZstdCompressor must not be shared between threads
+            return lambda data: zstandard.ZstdCompressor(level=max(1, level * 2)).compress(data)
+        return lambda data: lzma.compress(data, preset=min(level, 9))
+
+    def _decompressor(self, compression):
+        if compression == "zstd":
+            if zstandard is None:
+                raise RuntimeError("zstd archives need the zstandard module")
+            return zstandard.ZstdDecompressor().decompress
+        return lzma.decompress
+
+    def _cipher(self, password, encryption):
+        if AESGCM is None:
+            raise RuntimeError("encrypted archives need the cryptography module")
+        key = hashlib.scrypt(password.encode("utf-8"), salt=bytes.fromhex(encryption["salt"]),
+                             n=encryption["n"], r=encryption["r"], p=encryption["p"], dklen=32)
+        return AESGCM(key)
+
+    def _seal(self, cipher, header_digest, frame_type, number, payload):
+        if cipher is None:
+            return payload
+        nonce = os.urandom(12)
+        return nonce + cipher.encrypt(nonce, payload, frame_type + number.to_bytes(8, "big") + header_digest)
+
+    def _open(self, cipher, header_digest, frame_type, number, payload):
+        if cipher is None:
+            return payload
+        return cipher.decrypt(payload[:12], payload[12:], frame_type + number.to_bytes(8, "big") + header_digest)
+
+    def archive(self, archive_path, members, level, password = None, hash_algorithm = None):
+        """
+        :return: volumes, archive size, archive hash, member hashes (None without hash_algorithm)
+        """
+        archive_path += self.extention
+        remove_volumes(archive_path)
+        # 7z creates the directory of the archive, so do the same
+        os.makedirs(os.path.dirname(archive_path) or ".", exist_ok=True)
+        header = {"format": 1, "compression": self.compression, "level": level, "chunk_size": self.chunk_size}
+        if password:
+            header["encryption"] = {"cipher": "aes-256-gcm", "kdf": "scrypt", "salt": os.urandom(16).hex(), "n": 2 ** 14, "r": 8, "p": 1}
+        header_bytes = json.dumps(header).encode("utf-8")
+        header_digest = hashlib.sha256(header_bytes).digest()[:8]
+        cipher = self._cipher(password, header["encryption"]) if password else None
+        compress = self._compressor(self.compression, level)
+
+        archive_hash_function = change_detection.new_hash(hash_algorithm or "sha256")
+        writer = VolumeWriter(archive_path, self.volume_size_mb * 1000 * 1000, archive_hash_function)
+        try:
+            member_hashes, total_size = self._archive_members(writer, members, header_bytes, header_digest, cipher, compress, hash_algorithm)
+            volumes = writer.close()
+        except BaseException:
+            # no partial archive is left behind
+            writer.abort()
+            raise
+        archive_hash = change_detection.hash_value(hash_algorithm or "sha256", archive_hash_function)
+        return volumes, writer.size, archive_hash, member_hashes if hash_algorithm else None
+
+    def _archive_members(self, writer, members, header_bytes, header_digest, cipher, compress, hash_algorithm):
+        writer.write(self.magic)
+        self._write_frame(writer, b"H", header_bytes)
+
+        member_hashes = []
+        total_size = 0
+        frame_number = 0
+        window = deque()
+        buffer = bytearray()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            def enqueue(frame_type, payload, compressed):
+                nonlocal frame_number
+                frame_number += 1
+                function = (lambda data, n: self._seal(cipher, header_digest, frame_type, n, compress(data))) if compressed \
+                    else (lambda data, n: self._seal(cipher, header_digest, frame_type, n, data))
+                window.append((frame_type, executor.submit(function, payload, frame_number)))
+                while len(window) > self.threads * 2:
+                    self._write_frame(writer, *self._done(window.popleft()))
+
+            for file_path, name in members:
+                hash_function = change_detection.new_hash(hash_algorithm) if hash_algorithm else None
+                with open(file_path, "rb") as a_file:
+                    stat = os.fstat(a_file.fileno())
+                    enqueue(b"M", json.dumps({"name": name, "size": stat.st_size, "mtime": stat.st_mtime}).encode("utf-8"), False)
+                    read_size = 0
+                    for buf in iter(lambda: a_file.read(self.chunk_size), b""):
+                        read_size += len(buf)
+                        if hash_function is not None:
+                            hash_function.update(buf)
+                        buffer += buf
+                        while len(buffer) >= self.chunk_size:
+                            enqueue(b"C", bytes(buffer[:self.chunk_size]), True)
+                            del buffer[:self.chunk_size]
+                    if read_size != stat.st_size:
+                        raise RuntimeError(f"{file_path} changed while archiving")
+                total_size += read_size
+                if hash_function is not None:
+                    member_hashes.append(change_detection.hash_value(hash_algorithm, hash_function))
+
+            if buffer:
+                enqueue(b"C", bytes(buffer), True)
+            enqueue(b"Z", str(total_size).encode(), False)
+            while window:
+                self._write_frame(writer, *self._done(window.popleft()))
+        return member_hashes, total_size
+
+    def _done(self, item):
+        frame_type, future = item
+        return frame_type, future.result()
+
+    def _write_frame(self, writer, frame_type, payload):
+        writer.write(frame_type + len(payload).to_bytes(4, "big"))
+        writer.write(payload)
+
+    def _read_frame(self, reader):
+        head = reader.read(5)
+        if len(head) < 5:
+            raise ValueError("Truncated archive")
+        length = int.from_bytes(head[1:], "big")
+        payload = reader.read(length)
+        if len(payload) < length:
+            raise ValueError("Truncated archive")
+        return head[:1], payload
+
+    def _member_path(self, output_directory, name):
+        """
+        :return: path of the member in output_directory; ValueError for an absolute name
+            or one that leads out of output_directory
+        """
+        parts = name.replace("\\", "/").split("/")
+        if os.path.isabs(name) or os.path.splitdrive(name)[0] or ".." in parts:
+            raise ValueError(f"Unsafe member name - {name}")
+        file_path = os.path.join(output_directory, name)
+        root = os.path.realpath(output_directory)
+        if os.path.commonpath([root, os.path.realpath(file_path)]) != root:
+            raise ValueError(f"Unsafe member name - {name}")
+        return file_path
+
+    def _create(self, output_directory, name, extracted):
+        file_path = self._member_path(output_directory, name)
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        extracted.append(file_path)
+        return open(file_path, "wb")
+
+    def extract(self, volumes, output_directory, password = None, members = None):
+        """
+        Extract all members or only the named ones.
+
+        :return: list of extracted file paths
+        """
+        reader = VolumeReader(volumes)
+        extracted = []
+        output = None
+        try:
+            if reader.read(len(self.magic)) != self.magic:
+                raise ValueError("Not a stream archive")
+            frame_type, header_bytes = self._read_frame(reader)
+            header = json.loads(header_bytes)
+            header_digest = hashlib.sha256(header_bytes).digest()[:8]
+            cipher = None
+            if "encryption" in header:
+                if not password:
+                    raise ValueError("Archive is encrypted")
+                cipher = self._cipher(password, header["encryption"])
+            decompress = self._decompressor(header["compression"])
+
+            queue = deque()
+            frame_number = 0
+            total_size = 0
+            while True:
+                frame_type, payload = self._read_frame(reader)
+                frame_number += 1
+                payload = self._open(cipher, header_digest, frame_type, frame_number, payload)
+                if frame_type == b"M":
+                    queue.append(dict(json.loads(payload), left=None))
+                elif frame_type == b"C":
+                    data = memoryview(decompress(payload))
+                    total_size += len(data)
+                    while len(data) or (queue and queue[0]["size"] == 0 and queue[0]["left"] is None):
+                        member = queue[0]
+                        if member["left"] is None:
+                            member["left"] = member["size"]
+                            output = None
+                            if members is None or member["name"] in members:
+                                output = self._create(output_directory, member["name"], extracted)
+                        part = data[:member["left"]]
+                        if output is not None:
+                            output.write(part)
+                        member["left"] -= len(part)
+                        data = data[len(part):]
+                        if member["left"] == 0:
+                            if output is not None:
+                                output.close()
+                                os.utime(extracted[-1], (member["mtime"], member["mtime"]))
+                                output = None
+                            queue.popleft()
+                elif frame_type == b"Z":
+                    if int(payload) != total_size:
+                        raise ValueError("Archive size mismatch")
+                    for member in queue:
+                        if member["size"] == 0 and (members is None or member["name"] in members):
+                            self._create(output_directory, member["name"], extracted).close()
+                    break
+                else:
+                    raise ValueError(f"Unknown frame {frame_type}")
+        finally:
+            if output is not None:
+                output.close()
+            reader.close()
+        return extracted
+
+
+archivers = {"7z": SevenZipArchiver, "stream": StreamArchiver}
+
+
+def get_archiver(name = "auto", threads = None, volume_size_mb = None, seven_zip_path = None):
+    """
+    "7z", "stream" or "auto" - 7z if 7z.exe is found, the in-process archiver otherwise.
+    """
+    if name in ("7z", "auto"):
+        archiver = SevenZipArchiver(seven_zip_path, threads, volume_size_mb)
+        if name == "7z" or archiver.available():
+            return archiver
+    return StreamArchiver(threads, volume_size_mb)
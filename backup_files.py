@@ -1,31 +1,57 @@
 import os
 import sys
-import subprocess
 import time
-import tempfile
-import hashlib
+import contextlib
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
-from img_convert import AvifEnc, Magick
-from video_convert import FFMpegEnc
-from multiprocessing import Pool
-
-tmp_root = r"a:"
-if os.path.exists(tmp_root):
-    tmp_dir = os.path.join(tmp_root, "tmp")
-else:
-    tmp_dir = None
+from img_convert import AvifEnc, BaseConvert
+from metadata_cache import MetadataCache
+from probe import Prober
+from manifest import Manifest
+from video_convert import FFMpegEnc, optimize_video
+from scheduler import LaneScheduler
+from archiver import get_archiver, volume_names, hash_volumes
+from temp_storage import temp_directory
+from run_metrics import StageTimer, RunMetrics
+from resource_budget import ResourceBudget, storage_threads
+from file_copy import copy_file, copy_directory_times
+from tool_runner import get_tool_runner
+from watcher import get_watcher, Debouncer
+import change_detection
 
 source_dir = Path(__file__).resolve().parent
 avifenc_path = source_dir / "bin" / "avifenc" / "avifenc-dev.exe"
 ffmpeg_path = source_dir / "bin" / "ffmpeg_latest" / "ffmpeg.exe"
+ffprobe_path = source_dir / "bin" / "ffmpeg_latest" / "ffprobe.exe"
 exiftool_path = source_dir / "bin" / "extiftool" / "exiftool.exe"
-magick_path = Path(r"C:\Program Files\ImageMagick-7.1.0-Q16-HDRI\magick.exe")
-converter_video = FFMpegEnc(ffmpeg_path, 4, exiftool_path)
-converter_image = AvifEnc(avifenc_path, 8, "aom", 4, exiftool_path)
-magick = Magick(magick_path, exiftool_path)
+budget = ResourceBudget() # tool threads and lane workers from the cores and the cgroup CPU limit
+converter_video = FFMpegEnc(ffmpeg_path, budget.threads["video"], exiftool_path)
+converter_video.segment_jobs = budget.threads["video_segments"]
+converter_image = AvifEnc(avifenc_path, 8, "aom", budget.threads["image"], exiftool_path)
 q_image = 21 # 8 x 2; 15 x 3; 21 x 4;
 q_video = 29.5 # 29.5 x 2;
+min_expected_ratio = 1.5 # files with a lower predicted ratio are archived without encoding, 0 - encode all
+video_ratio = None # per-title quality for this ratio from sample clips instead of q_video, e.g. 8
+video_format = "hevc_nvenc" # hevc_nvenc (NVIDIA GPU), hevc (libx265) or av1 (SVT-AV1) - segment-parallel on the CPU
+default_lanes = None # concurrent jobs per resource, e.g. {"video": 1, "image": 2, "archive": 2, "hash": 4}; None - budget.lanes, adjusted during the run
+hash_algorithm = "sha256" # sha256, blake2b, xxh3 (needs xxhash)
+stream_archive = True # not encoded files are read once and hashed while they are archived
+archiver_backend = "auto" # 7z, stream (in-process, see archiver.py), auto - 7z if it is installed
+volume_size_mb = 1000
+deduplicate_files = False # identical files share one archive in <destination>/.objects
+pack_threshold = 64 * 1024 # new or changed files below this size are packed per directory into solid archives, 0 - off
+pack_max_files = 1000
+metrics_log = ".metrics.jsonl" # per-file stage timings appended in the destination, None - off
+prometheus_file = None # Prometheus textfile written after the run, e.g. /var/lib/node_exporter/textfile/transcoder.prom
+tool_timeout = 6 * 3600 # seconds one tool run may take, then it is killed (a failed encode is archived as is), None - no limit
+get_tool_runner().timeout = tool_timeout
+watch_debounce = 10.0 # seconds without events before a changed file is backed up in watch mode
+watch_reconcile_hours = 24 # full scan in watch mode for events that were missed, 0 - only at the start
+watch_poll_interval = 300.0 # seconds between scans where inotify is not available
+copy_threads = None # concurrent copies in copy mode, None - from the source and destination storage (2 for spinning disks)
+archiver = get_archiver(archiver_backend, budget.threads["archive"], volume_size_mb)
+prober = Prober(ffprobe_path=ffprobe_path)
 
 
 def read_arguments(_arguments):
@@ -42,102 +68,117 @@ def read_arguments(_arguments):
         return _arguments[1:]
 
 def get_hash(file_path):
-    block_size = 65536
-    hash_function = hashlib.sha256()
-    with open(file_path, 'rb') as a_file:
-        buf = a_file.read(block_size)
-        while len(buf) > 0:
-            hash_function.update(buf)
-            buf = a_file.read(block_size)
-    return hash_function.hexdigest()
-
-
-def write_hash_file(hash_file_path, hash_source_file, hash_archive_file, mtime_source_file, ctime_source_file):
-    with open(hash_file_path, "w") as hash_file:
-        hash_file.write(hash_source_file + hash_archive_file + "\n")
-        hash_file.write(mtime_source_file + "\n")
-        hash_file.write(ctime_source_file + "\n")
-
-
-def read_hash_file(hash_file_path):
-    if not os.path.exists(hash_file_path):
-        return "", "", None, None
-
-    with open(hash_file_path, "r") as hash_file:
-        lines = hash_file.readlines()
-    hash_line = lines[0].strip()
-    div_position = len(hash_line) // 2
-    hash_source_file = hash_line[:div_position]
-    hash_archive_file = hash_line[div_position:]
-    if len(lines) >= 3:
-        mtime_source_file = lines[1].strip()
-        ctime_source_file = lines[2].strip()
-    else:
-        mtime_source_file = None
-        ctime_source_file = None
-    return hash_source_file, hash_archive_file, mtime_source_file, ctime_source_file
+    return change_detection.get_hash(file_path, hash_algorithm)
 
 
-def compress_file(root, source, destination, password):
-    start_time = time.time()
-    volume_size_mb = 1000
-    cmd_m1 = [r"C:\Program Files\7-zip\7z.exe", "a", "-t7z", "-mx1", "-mmt=4", "-bso0", "-v%im" % volume_size_mb]
-    cmd_m9 = [r"C:\Program Files\7-zip\7z.exe", "a", "-t7z", "-mx6", "-mmt=4", "-bso0", "-v%im" % volume_size_mb]
+def get_lane(source):
+    extention = os.path.splitext(source)[1].lower()
+    if extention in [".mp4", ".mkv"]:
+        return "video"
+    if extention in [".jpg", ".jpeg"]:
+        return "image"
+    return "archive"
+
+
+def verify_file(root, source, stored_hash = None):
+    """
+    Hash a source file whose dates changed since the last backup,
+    with the algorithm of the stored hash (hash_algorithm if there is none).
+
+    :return: source, hash of the source file, True if the content is unchanged, stage timings
+    """
+    timer = StageTimer(source)
+    with timer.stage("hash", os.path.getsize(os.path.join(root, source))):
+        if stored_hash is None:
+            result = source, get_hash(os.path.join(root, source)), False
+        else:
+            result = (source, ) + change_detection.same_content(os.path.join(root, source), stored_hash)
+    return result + (timer.result(), )
+
+
+def object_name(hash_source_file):
+    """
+    Destination relative archive name of a content-addressed object.
+    """
+    digest = change_detection.split_hash(hash_source_file)[1]
+    return os.path.join(".objects", digest[:2], digest)
 
+
+def move_object(volumes, archive_path, object_path, archive_hash):
+    """
+    Move a content-addressed archive to the object of the content it really has; if
+    that object exists already, it is kept and the new volumes are removed.
+
+    :return: volumes, archive size, archive hash
+    """
+    existing = [path for path in [object_path + archiver.extention] + volume_names(object_path + archiver.extention) if os.path.exists(path)]
+    if existing:
+        for volume in volumes:
+            os.remove(volume)
+        return existing, sum(map(os.path.getsize, existing)), hash_volumes(existing, hash_algorithm)
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    moved = [object_path + volume[len(archive_path):] for volume in volumes]
+    for volume, target in zip(volumes, moved):
+        os.replace(volume, target)
+    return moved, sum(map(os.path.getsize, moved)), archive_hash
+
+
+def compress_file(root, source, destination, password, hash_source_file = None, archive_name = None):
+    start_time = time.time()
+    timer = StageTimer(source)
     encoded_path = None
     source_path = os.path.join(root, source)
     source_file_name_ext = os.path.split(source)[1]
     source_file_name, source_file_ext = os.path.splitext(source_file_name_ext)
     
-    archive_path = os.path.join(destination, source) + ".7z"
-    archive_volume_path1 = archive_path + ".001"
-    archive_volume_path2 = archive_path + ".002"
-    hash_path = os.path.join(destination, source) + ".hash"
-
-    exists_hash_source_file, exists_hash_archive_file, exists_mtime_source_file, exists_ctime_source_file = (None, None, None, None)
-    if os.path.exists(hash_path):
-        exists_hash_source_file, exists_hash_archive_file, exists_mtime_source_file, exists_ctime_source_file = read_hash_file(hash_path)
-
-    hash_source_file = None
-    mtime_source_file = str(os.path.getmtime(source_path))
-    ctime_source_file = str(os.path.getctime(source_path))
-
-    file_exists = os.path.exists(archive_path) or os.path.exists(archive_volume_path1)
-    dates_are_identical = (exists_mtime_source_file == mtime_source_file) and (exists_ctime_source_file == ctime_source_file)
-
-    if file_exists and not dates_are_identical:
-        hash_source_file = get_hash(source_path)
-        file_exists = hash_source_file == exists_hash_source_file
-
-    if file_exists:
-        if not (exists_mtime_source_file and exists_ctime_source_file):
-            write_hash_file(hash_path, exists_hash_source_file, exists_hash_archive_file, mtime_source_file, ctime_source_file)
-        print("Skipped: %s" % (source_path, ))
-        return 0, 0, 0.0
-
-    with tempfile.TemporaryDirectory(prefix=tmp_dir) as tmpdirname:
-        if source_file_ext.lower() in [".jpg", ".jpeg", ".mp4", ".mkv"]:
+    archive_path = os.path.join(destination, archive_name or source)
+
+    mtime_source_file = os.path.getmtime(source_path)
+    ctime_source_file = os.path.getctime(source_path)
+    encoder = None
+
+    encoded = source_file_ext.lower() in [".jpg", ".jpeg", ".mp4", ".mkv"]
+    if encoded and min_expected_ratio:
+        with timer.stage("probe"):
+            probe = prober.probe(source_path)
+            expected_ratio, reason = prober.expected_ratio(probe)
+        if expected_ratio is not None and expected_ratio < min_expected_ratio:
+            print("Not encoding: %s expected ratio %.2f < %.2f (%s)" % (source_path, expected_ratio, min_expected_ratio, reason))
+            encoded = False
+    # the encoded file is expected to be smaller than the source
+    with temp_directory(os.path.getsize(source_path)) if encoded else contextlib.nullcontext() as tmpdirname:
+        if encoded:
             result_path = os.path.join(tmpdirname, source_file_name)
 
             ok = False
             if source_file_ext.lower() in [".jpg", ".jpeg"]:
                 converter = converter_image
-                try:                
-                    result_path_oriented = os.path.join(tmpdirname, source_file_name_ext)
-                    magick.auto_orient(source_path, result_path_oriented)
-                    encoded_path, encoded_size = converter_image.convert_to_avif(result_path_oriented, result_path, q_image)
+                try:
+                    with timer.stage("encode", os.path.getsize(source_path)):
+                        encoded_path, encoded_size = converter_image.convert_to_avif_oriented(source_path, result_path, q_image)
+                    encoder = f"avifenc {converter_image.codec} s{converter_image.speed} q{q_image}"
                 except Exception as e:
                     print("ERROR (Image conversion):", e, encoded_path)
             else:
                 converter = converter_video
                 try:
-                    encoded_path, encoded_size = converter_video.convert_to_hevc_nvenc(source_path, result_path, q_video)
+                    q = q_video
+                    if video_ratio:
+                        with timer.stage("optimize"):
+                            q = optimize_video(converter_video, video_format, source_path, [video_ratio])[video_ratio]
+                    with timer.stage("encode", os.path.getsize(source_path)):
+                        encoded_path, encoded_size = converter_video.get_function(video_format)[0](source_path, result_path, q)
+                    encoder = f"{video_format} cq{q}"
                 except Exception as e:
                     print("ERROR (Video conversion):", e, encoded_path)
 
-            if encoded_path is not None: 
-                converter.copy_exif(source_path, encoded_path)
-                converter.update_file_date_from_old_file(source_path, encoded_path)                
+            if encoded_path is not None:
+                if min_expected_ratio:
+                    prober.add_result(probe, os.path.getsize(source_path) / encoded_size)
+                with timer.stage("metadata"):
+                    if converter is converter_video:
+                        converter.copy_exif(source_path, encoded_path)
+                    converter.update_file_date_from_old_file(source_path, encoded_path)
 
         if encoded_path is not None:
             file_to_archive_path = encoded_path
@@ -147,125 +188,345 @@ def compress_file(root, source, destination, password):
         source_file_size = os.path.getsize(source_path)
         print("Processing: %s %.2f Mb" % (source_path, source_file_size / (1024*1024)))
 
-        if password:
-            cmd_m1.append("-p%s" % password)
-            cmd_m9.append("-p%s" % password)
+        if source_file_ext.lower() in [".jpg", ".jpeg", ".mp4", ".mkv", ".webp", ".png", ".avi", ".rar", ".7z", ".zip", ".gz"]:
+            level = 1
+        else:
+            level = 6
+
+        # not encoded files are read once: hashed while they are archived
+        streamed = stream_archive and file_to_archive_path == source_path
+        with timer.stage("archive", os.path.getsize(file_to_archive_path)):
+            volumes, archive_file_size, hash_archive_file, member_hashes = archiver.archive(
+                archive_path, [(file_to_archive_path, os.path.basename(file_to_archive_path))], level, password, hash_algorithm if streamed else None)
+        if streamed:
+            if archive_name and hash_source_file and member_hashes[0] != hash_source_file:
+                # changed since it was hashed: the object belongs to the new content
+                volumes, archive_file_size, hash_archive_file = move_object(
+                    volumes, archive_path, os.path.join(destination, object_name(member_hashes[0])), hash_archive_file)
+            hash_source_file = member_hashes[0]
+        elif not hash_source_file:
+            with timer.stage("hash", source_file_size):
+                hash_source_file = get_hash(source_path)
+
+        record = {
+            "path": source,
+            "size": source_file_size,
+            "mtime": mtime_source_file,
+            "ctime": ctime_source_file,
+            "source_hash": hash_source_file,
+            "archive_hash": hash_archive_file,
+            "volumes": [os.path.relpath(volume, destination) for volume in volumes],
+            "encoder": f"{encoder}; {archiver.settings(level)}" if encoder else archiver.settings(level),
+        }
 
-        cmd_m1.extend([archive_path, file_to_archive_path])
-        cmd_m9.extend([archive_path, file_to_archive_path])
+        end_time = time.time() - start_time
+        print("Finished: %s %.2f Mb, %.2f s" % (source_path, archive_file_size / (1024*1024), end_time))
+    return source_file_size, archive_file_size, end_time, record, timer.result()
 
-        if os.path.exists(archive_path):
-            os.remove(archive_path)
+def pack_files(root, sources, destination, password):
+    """
+    Put small files of one directory into a solid archive.
 
-        for i in range((source_file_size // (1000*1000*(volume_size_mb // 10))) + 1):
-            archive_volume_path = archive_path + ".%03i" % i
-            if os.path.exists(archive_volume_path):
-                os.remove(archive_volume_path)
-                
-        if source_file_ext.lower() in [".jpg", ".jpeg", ".mp4", ".mkv", ".webp", ".png", ".avi", ".rar", ".7z", ".zip", ".gz"]:
-            subprocess.run(cmd_m1)
-        else:
-            subprocess.run(cmd_m9)
-
-        archive_file_size = os.path.getsize(archive_volume_path1)
-
-        if os.path.exists(archive_volume_path2):
-            i = 2
-            while True:
-                tmp_name = f"{archive_path}.{i:03d}"
-                if os.path.exists(tmp_name):
-                    archive_file_size += os.path.getsize(tmp_name)
-                    i += 1
-                else:
-                    break
-            archive_path = archive_volume_path1                
-        else:
-            os.rename(archive_volume_path1, archive_path)
+    :return: source size, archive size, time, list of records (member - file name in the pack), stage timings
+    """
+    start_time = time.time()
+    timer = StageTimer(os.path.dirname(sources[0]))
+    directory = os.path.dirname(sources[0])
+    pack_name = ".pack-%i-%i" % (time.time() * 1000, os.getpid())
+    archive_path = os.path.join(destination, directory, pack_name)
+    members = [(os.path.join(root, source), os.path.basename(source)) for source in sources]
 
-        hash_archive_file = get_hash(archive_path)
+    records = []
+    source_files_size = 0
+    for source in sources:
+        stat = os.stat(os.path.join(root, source))
+        source_files_size += stat.st_size
+        records.append({
+            "path": source,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "ctime": stat.st_ctime,
+            "encoder": archiver.settings(6) + " solid",
+            "member": os.path.basename(source),
+        })
+    print("Packing: %i files %.2f Mb into %s" % (len(sources), source_files_size / (1024*1024), archive_path))
+
+    with timer.stage("pack", source_files_size):
+        volumes, archive_file_size, hash_archive_file, member_hashes = archiver.archive(archive_path, members, 6, password, hash_algorithm)
+    for record, hash_source_file in zip(records, member_hashes):
+        record["source_hash"] = hash_source_file
+        record["archive_hash"] = hash_archive_file
+        record["volumes"] = [os.path.relpath(volume, destination) for volume in volumes]
+
+    end_time = time.time() - start_time
+    print("Finished: %s %.2f Mb, %.2f s" % (volumes[0], archive_file_size / (1024*1024), end_time))
+    return source_files_size, archive_file_size, end_time, records, timer.result()
+
+
+def init_worker(metadata_cache_path):
+    global prober
+    BaseConvert.metadata_cache = MetadataCache(metadata_cache_path)
+    prober = Prober(metadata_cache_path, ffprobe_path)
+
+
+def prescan_metadata(source, destination, paths = None):
+    os.makedirs(destination, exist_ok=True)
+    metadata_cache_path = os.path.join(destination, ".metadata.db")
+    start_time = time.time()
+    files_count = MetadataCache(metadata_cache_path).prescan(source, exiftool_path, files=paths)
+    print("Metadata pre-scan: %i files, %.2f s" % (files_count, time.time() - start_time))
+    return metadata_cache_path
 
-        if not hash_source_file:
-            hash_source_file = get_hash(source_path)
-        write_hash_file(hash_path, hash_source_file, hash_archive_file, mtime_source_file, ctime_source_file)
 
-        archive_file_size += os.path.getsize(hash_path)
+def open_manifest(destination):
+    os.makedirs(destination, exist_ok=True)
+    manifest = Manifest(destination)
+    if manifest.count() == 0:
+        imported = manifest.import_hash_files()
+        if imported:
+            print("Imported %i .hash files into %s" % (imported, manifest.db_path))
+    return manifest
 
-        end_time = time.time() - start_time
-        print("Finished: %s %.2f Mb, %.2f s" % (source_path, archive_file_size / (1024*1024), end_time))
-    return source_file_size, archive_file_size, end_time
 
-def compress_files(source, destination, password):
+def compress_files(source, destination, password, lanes = None, deduplicate = None, paths = None):
+    """
+    :param paths: relative paths to back up (watch mode), None - scan the whole source tree
+    """
     total_start_time = time.time()
-    pure_compressing_time = 0.0
-    source_files_size = 0
-    archived_files_size = 0
-    total_files_count = 0
-    processed_files_count = 0
-    div_position = len(source) + 1
-    workers = []
-    pool_size = 2
-    with Pool(processes=pool_size) as pool:    
-        for root, dirs, files in os.walk(source):
-            for i_file in files:
-                while len(workers) > pool_size*2:
-                    for work in reversed(workers):
-                        if work.ready():
-                            source_file_size, archived_file_size, compressing_time = work.get()
-
-                            if compressing_time:
-                                processed_files_count += 1
-                                pure_compressing_time += compressing_time
-                                source_files_size += source_file_size
-                                archived_files_size += archived_file_size
-                            total_files_count += 1
-                            workers.remove(work)
-
-                relative_source = os.path.join(root, i_file)[div_position:]
-                workers.append(pool.apply_async(compress_file, (source, relative_source, destination, password)))
-
-        total_working_time = time.time() - total_start_time
-
-        while len(workers) > 0:
-            for work in reversed(workers):
-                if work.ready():
-                    source_file_size, archived_file_size, compressing_time = work.get()
-
-                    if compressing_time:
-                        processed_files_count += 1
-                        pure_compressing_time += compressing_time
-                        source_files_size += source_file_size
-                        archived_files_size += archived_file_size
-                    total_files_count += 1
-                    workers.remove(work)
+    metadata_cache_path = prescan_metadata(source, destination, paths)
+    statistics = {"total": 0, "processed": 0, "source_size": 0, "archived_size": 0, "compressing_time": 0.0, "duplicates": 0, "failed": 0}
+    manifest = open_manifest(destination)
+    if deduplicate is None:
+        deduplicate = deduplicate_files
+    hashing = {}
+    duplicates = {}
+    objects = {} # relative source: content hash its object was submitted with
+
+    def add_reference(relative_source, stat, record):
+        print("Duplicate: %s" % (os.path.join(source, relative_source), ))
+        manifest.put(dict(record, path=relative_source, size=stat.st_size, mtime=stat.st_mtime, ctime=stat.st_ctime))
+        statistics["duplicates"] += 1
+        statistics["total"] += 1
+
+    def on_hashed(relative_source, stat, hash_source_file):
+        if not deduplicate:
+            scheduler.submit(get_lane(relative_source), compress_file, source, relative_source, destination, password, hash_source_file)
+            return
+        if hash_source_file is None:
+            hashing[relative_source] = stat
+            scheduler.submit("hash", verify_file, source, relative_source)
+            return
+
+        stored = manifest.find_hash(hash_source_file)
+        if stored is not None:
+            add_reference(relative_source, stat, stored)
+        elif hash_source_file in duplicates:
+            duplicates[hash_source_file].append((relative_source, stat))
+        else:
+            duplicates[hash_source_file] = []
+            submit_object(relative_source, hash_source_file)
+
+    def submit_object(relative_source, hash_source_file):
+        objects[relative_source] = hash_source_file
+        scheduler.submit(get_lane(relative_source), compress_file, source, relative_source, destination, password,
+                         hash_source_file, object_name(hash_source_file))
+
+    def submit_waiting(hash_source_file):
+        # the next file with the same content takes the place of the submitted one
+        waiting = duplicates.pop(hash_source_file, [])
+        if waiting:
+            (relative_source, stat), duplicates[hash_source_file] = waiting[0], waiting[1:]
+            submit_object(relative_source, hash_source_file)
+
+    def on_error(lane, function, args, e):
+        statistics["failed"] += 1
+        if function is not compress_file or len(args) < 6:
+            return
+        objects.pop(args[1], None)
+        submit_waiting(args[4])
+
+    def on_done(lane, result):
+        run_metrics.add(lane, result[-1])
+        if lane == "hash":
+            relative_source, hash_source_file, unchanged, timings = result
+            stat = hashing.pop(relative_source)
+            if unchanged:
+                print("Skipped: %s" % (os.path.join(source, relative_source), ))
+                manifest.update_dates(relative_source, stat.st_mtime, stat.st_ctime)
+                statistics["total"] += 1
+            else:
+                if change_detection.split_hash(hash_source_file)[0] != hash_algorithm:
+                    hash_source_file = None
+                on_hashed(relative_source, stat, hash_source_file)
+            return
+
+        source_file_size, archived_file_size, compressing_time, records, timings = result
+        if not isinstance(records, list):
+            records = [records]
+        for record in records:
+            manifest.put(record)
+            submitted_hash = objects.pop(record["path"], record["source_hash"])
+            if submitted_hash != record["source_hash"]:
+                # the file changed while it was archived, the waiting files still have the submitted content
+                submit_waiting(submitted_hash)
+                continue
+            for relative_source, stat in duplicates.pop(submitted_hash, []):
+                add_reference(relative_source, stat, record)
+        if compressing_time:
+            statistics["processed"] += len(records)
+            statistics["compressing_time"] += compressing_time
+            statistics["source_size"] += source_file_size
+            statistics["archived_size"] += archived_file_size
+        statistics["total"] += len(records)
+
+    run_metrics = RunMetrics(os.path.join(destination, metrics_log) if metrics_log else None, prometheus_file)
+    lanes = lanes or default_lanes
+    print("CPUs: %i, lanes: %s, threads: %s" % (budget.cpus, lanes or budget.lanes, budget.threads))
+    with manifest, run_metrics, LaneScheduler(lanes or budget.lanes, on_done, initializer=init_worker, initargs=(metadata_cache_path, ),
+                                              max_workers=None if lanes else budget.max_workers(),
+                                              budget=None if lanes else budget, on_error=on_error) as scheduler:
+        pack = []
+        if paths is None:
+            changes = change_detection.detect_changes(source, manifest)
+        else:
+            changes = change_detection.detect_paths(source, manifest, paths)
+        for relative_source, stat, record, action in changes:
+            if pack and (os.path.dirname(relative_source) != os.path.dirname(pack[0]) or len(pack) >= pack_max_files):
+                scheduler.submit("archive", pack_files, source, pack, destination, password)
+                pack = []
+
+            if action == "skip":
+                print("Skipped: %s" % (os.path.join(source, relative_source), ))
+                statistics["total"] += 1
+            elif action == "verify":
+                # only the dates changed: hash first, small files too, the pack copy may still be valid
+                hashing[relative_source] = stat
+                scheduler.submit("hash", verify_file, source, relative_source, record["source_hash"])
+            elif stat.st_size < pack_threshold and get_lane(relative_source) == "archive":
+                pack.append(relative_source)
+            else:
+                on_hashed(relative_source, stat, None)
+        if pack:
+            scheduler.submit("archive", pack_files, source, pack, destination, password)
+        scheduler.join()
+
+    total_working_time = time.time() - total_start_time
                 
     print("Finished")
     print("Statistics:")
-    print("\tTotal files count:", total_files_count)
-    print("\tTotal files compressed:", processed_files_count)
-    print("\tSource files size:  %.2fMb" % (source_files_size / (1024*1024)))
-    print("\tArchived files size:  %.2fMb" % (archived_files_size / (1024*1024)))
+    print("\tTotal files count:", statistics["total"])
+    print("\tTotal files compressed:", statistics["processed"])
+    print("\tDuplicate files:", statistics["duplicates"])
+    print("\tFailed files:", statistics["failed"])
+    print("\tSource files size:  %.2fMb" % (statistics["source_size"] / (1024*1024)))
+    print("\tArchived files size:  %.2fMb" % (statistics["archived_size"] / (1024*1024)))
     print("\tReal working time: %.2fs" % total_working_time)
-    print("\tTotal working time: %.2fs" % pure_compressing_time)
+    print("\tTotal working time: %.2fs" % statistics["compressing_time"])
+    run_metrics.print_summary()
+    run_metrics.write_prometheus()
 
 
-def copy_files(source, destination):
+def watch_files(source, destination, password):
+    """
+    Back up changed files as they arrive: a full scan at the start and every
+    watch_reconcile_hours, in between only the paths reported by inotify (or a polling
+    scan), after they stayed unchanged for watch_debounce seconds.
+    """
+    debouncer = Debouncer(watch_debounce)
+    # the destination may be inside the source, its own writes are no changes
+    destination_prefix = destination[len(source) + 1:] + os.sep if destination.startswith(source + os.sep) else None
+    # watch before the first scan, so files changed during it are reported afterwards
+    with get_watcher(source, watch_poll_interval) as watcher:
+        print("Watching: %s (%s)" % (source, watcher.name))
+        compress_files(source, destination, password)
+        last_reconcile = time.time()
+        while True:
+            timeouts = [debouncer.timeout()]
+            if watch_reconcile_hours:
+                timeouts.append(max(last_reconcile + watch_reconcile_hours * 3600 - time.time(), 0))
+            timeouts = [timeout for timeout in timeouts if timeout is not None]
+            changed = watcher.read(min(timeouts) if timeouts else None)
+            if changed is None:
+                print("WARNING: watch - events were lost, full scan")
+            else:
+                debouncer.add(path for path in changed if not destination_prefix or not (path + os.sep).startswith(destination_prefix))
+            if changed is None or (watch_reconcile_hours and time.time() - last_reconcile >= watch_reconcile_hours * 3600):
+                debouncer.clear()
+                compress_files(source, destination, password)
+                last_reconcile = time.time()
+                continue
+            ready = debouncer.ready()
+            if ready:
+                compress_files(source, destination, password, paths=ready)
+
+
+def copy_files(source, destination, threads = None):
+    """
+    Mirror the source tree: new and changed files are copied by a thread pool (reflink,
+    copy_file_range or sendfile, see file_copy.py) with their timestamps, unchanged ones
+    are skipped by the manifest like in compress mode.
+    """
     total_start_time = time.time()
-    total_files_count = 0
-    processed_files_count = 0
-    div_position = len(source) + 1
-    for root, dirs, files in os.walk(source):
-        for i_file in files:
-            relative_source = os.path.join(root, i_file)[div_position:]
-            # file_size = compress_file(source, relative_source, destination)
-
-            total_files_count += 1
+    statistics = {"total": 0, "processed": 0, "source_size": 0, "methods": {}}
+    manifest = open_manifest(destination)
+    threads = threads or copy_threads or storage_threads(source, destination)
+    print("Copy threads: %i" % threads)
+    directories = set()
+    running = {}
+
+    def on_done(future):
+        relative_source, stat = running.pop(future)
+        try:
+            method = future.result()
+        except Exception as e:
+            print("ERROR (copy):", e, os.path.join(source, relative_source))
+            return
+        manifest.put({
+            "path": relative_source,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "ctime": stat.st_ctime,
+            "volumes": [relative_source],
+            "encoder": "copy",
+        })
+        print("Copied: %s %.2f Mb (%s)" % (os.path.join(source, relative_source), stat.st_size / (1024*1024), method))
+        statistics["processed"] += 1
+        statistics["source_size"] += stat.st_size
+        statistics["methods"][method] = statistics["methods"].get(method, 0) + 1
+
+    with manifest, ThreadPoolExecutor(max_workers=threads) as executor:
+        for relative_source, stat, record, action in change_detection.detect_changes(source, manifest):
+            statistics["total"] += 1
+            destination_path = os.path.join(destination, relative_source)
+            if action == "skip" and os.path.exists(destination_path) and os.path.getsize(destination_path) == stat.st_size:
+                continue
+
+            directory = os.path.dirname(relative_source)
+            while directory not in directories:
+                directories.add(directory)
+                directory = os.path.dirname(directory)
+
+            # a bounded number of queued copies, the manifest is written from this thread only
+            while len(running) >= threads * 4:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    on_done(future)
+            running[executor.submit(copy_file, os.path.join(source, relative_source), destination_path, stat)] = (relative_source, stat)
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                on_done(future)
+    copy_directory_times(source, destination, directories)
     total_working_time = time.time() - total_start_time
 
     print("Finished")
     print("Statistics:")
-    print("\tTotal files count:", total_files_count)
-    print("\tTotal files compressed:", processed_files_count)
-    print("\tTotal working time: %.2fs" % total_working_time)
+    print("\tTotal files count:", statistics["total"])
+    print("\tTotal files copied:", statistics["processed"])
+    print("\tCopied files size:  %.2fMb" % (statistics["source_size"] / (1024*1024)))
+    print("\tCopy methods:", ", ".join("%s %i" % item for item in sorted(statistics["methods"].items())) or "-")
+    print("\tTotal working time: %.2fs, %.2f MB/s" % (total_working_time, statistics["source_size"] / max(total_working_time, 1e-9) / (1024*1024)))
 
 
 def print_help():
@@ -273,11 +534,12 @@ def print_help():
     print("""Arguments: mode source_path destination_path
           \tModes: compress
           \t\tOptions: password(optional)              
+          \t       watch - compress, then back up changed files as they arrive
+          \t\tOptions: password(optional)
+          \t       copy - mirror new and changed files without encoding
+          \t\tOptions: none
           """)
 
-#          \t       copy
-#          \t\tOptions: none
-
 
 if __name__ == "__main__":
     print("Per file backup v 0.2")
@@ -289,14 +551,14 @@ if __name__ == "__main__":
 
     if arguments_count > 1:
         mode = arguments[0]
-        if mode not in ("compress", "copy"):
+        if mode not in ("compress", "watch", "copy"):
             print_help()
             exit(1)
 
     print(f"mode: {mode}")
     source_path = arguments[1]
     destination_path = arguments[2]
-    if len(arguments) > 4 and mode == "compress":
+    if len(arguments) > 4 and mode in ("compress", "watch"):
         archive_password = arguments[3]
     else:
         archive_password = None
@@ -304,6 +566,11 @@ if __name__ == "__main__":
     destination_path = os.path.abspath(destination_path)
     if mode == "compress":
         compress_files(source_path, destination_path, archive_password)
+    elif mode == "watch":
+        try:
+            watch_files(source_path, destination_path, archive_password)
+        except KeyboardInterrupt:
+            print("Stopped")
     elif mode == "copy":
         copy_files(source_path, destination_path)
 
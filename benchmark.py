@@ -0,0 +1,290 @@
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import platform
+import itertools
+import subprocess
+
+from pathlib import Path
+from PIL import features
+from img_convert import AvifEnc, HeicEnc, Pillow, Magick
+from video_convert import FFMpegEnc
+from temp_storage import temp_directory
+from resource_budget import available_cpus
+
+try:
+    import resource
+except ImportError:
+    resource = None # Windows: no CPU time and peak RSS per cell
+
+try:
+    import metrics
+except ImportError:
+    metrics = None
+
+source_dir = Path(__file__).resolve().parent
+
+# tool: candidates, the first one found is used
+tool_paths = {
+    "avifenc": [source_dir / "bin" / "avifenc" / "avifenc-dev.exe", "avifenc"],
+    "heicenc": [source_dir / "bin" / "heifenc" / "heif-enc.exe", "heif-enc"],
+    "magick": [Path(r"C:\Program Files\ImageMagick-7.1.0-Q16-HDRI\magick.exe"), "magick"],
+    "ffmpeg": [source_dir / "bin" / "ffmpeg_latest" / "ffmpeg.exe", "ffmpeg"],
+}
+
+# every list is a matrix axis; "Test1" of codecs.txt is the avifenc entry
+default_matrix = [
+    {"method": "avifenc", "format": "avif", "codec": ["aom", "rav1e"], "speed": [6, 10], "threads": [0], "quality": [31]},
+    {"method": "heicenc", "format": ["heic", "avif"], "quality": [50]},
+    {"method": "magick", "format": ["jpeg", "webp", "avif"], "quality": [80]},
+    {"method": "pil", "format": ["jpeg", "webp", "jpeg2000"], "quality": [80]},
+    {"method": "ffmpeg", "format": ["hevc_nvenc", "hevc", "av1"], "threads": [4], "quality": [28]},
+]
+axes = ["method", "format", "codec", "speed", "threads", "quality"]
+
+time_tolerance = 0.10 # slower than the baseline by more than this is a regression
+ratio_tolerance = 0.02
+psnr_tolerance = 0.1 # dB
+
+
+def find_tool(name):
+    for candidate in tool_paths[name]:
+        if os.path.exists(candidate):
+            return str(candidate)
+        found = shutil.which(str(candidate))
+        if found:
+            return found
+    return None
+
+
+def expand(matrix):
+    """
+    :return: list of cells, one value per axis
+    """
+    cells = []
+    for entry in matrix:
+        values = [entry[axis] if isinstance(entry.get(axis), list) else [entry.get(axis)] for axis in axes]
+        cells += [dict(zip(axes, combination)) for combination in itertools.product(*values)]
+    return cells
+
+
+def cell_name(cell):
+    return " ".join(f"{axis}={cell[axis]}" for axis in axes if cell.get(axis) is not None)
+
+
+def make_converter(cell):
+    method = cell["method"]
+    threads = cell.get("threads")
+    if threads == 0:
+        threads = available_cpus()
+    if method == "pil":
+        return Pillow()
+    tool = find_tool("ffmpeg" if method == "ffmpeg" else method)
+    if tool is None:
+        return None
+    if method == "avifenc":
+        return AvifEnc(tool, cell.get("speed"), cell.get("codec"), threads)
+    if method == "heicenc":
+        return HeicEnc(tool)
+    if method == "magick":
+        return Magick(tool)
+    if method == "ffmpeg":
+        return FFMpegEnc(tool, threads)
+    return None
+
+
+def unavailable(cell):
+    """
+    :return: reason why the cell can not run here or None
+    """
+    converter = make_converter(cell)
+    if converter is None:
+        return f"{cell['method']} not found"
+    if converter.get_function(cell["format"])[0] is None:
+        return f"unknown format {cell['format']}"
+    if cell["method"] == "pil":
+        feature = {"webp": "webp", "jpeg2000": "jpg_2000", "jpeg": "jpg"}.get(cell["format"])
+        if feature and not features.check(feature):
+            return f"Pillow without {feature}"
+    if cell["method"] == "ffmpeg":
+        encoder = {"hevc_nvenc": "hevc_nvenc", "hevc": "libx265", "av1": "libsvtav1"}[cell["format"]]
+        res = subprocess.run([str(converter.ffmpeg_path), "-hide_banner", "-encoders"], capture_output=True, text=True).stdout
+        if f" {encoder} " not in res:
+            return f"ffmpeg without {encoder}"
+    return None
+
+
+def encode_cell(cell, input_files, output_directory):
+    """
+    Child process side: encode every input file, nothing else, so the resource usage
+    of the process tree is the cost of the encoder.
+
+    :return: list of (input file, output file, encode time)
+    """
+    convert = make_converter(cell).get_function(cell["format"])[0]
+    results = []
+    for i, input_file in enumerate(input_files):
+        start = time.perf_counter()
+        output_file, output_size = convert(input_file, os.path.join(output_directory, str(i)), cell["quality"])
+        results.append((input_file, output_file, time.perf_counter() - start))
+    return results
+
+
+def run_cell(cell, input_files, output_directory):
+    """
+    Run encode_cell in a child process; CPU time and peak RSS of the child and the
+    encoders it started come from wait4.
+    """
+    process = subprocess.Popen([sys.executable, __file__, "--cell", json.dumps(cell), "--output_directory", output_directory] + input_files,
+                               stdout=subprocess.PIPE, text=True)
+    output = process.stdout.read()
+    process.stdout.close()
+    if resource is not None:
+        _, status, usage = os.wait4(process.pid, 0)
+        returncode = os.waitstatus_to_exitcode(status)
+        process.returncode = returncode
+        cpu_time = usage.ru_utime + usage.ru_stime
+        peak_rss_mb = usage.ru_maxrss / 1024 # kilobytes on Linux
+    else:
+        returncode = process.wait()
+        cpu_time = None
+        peak_rss_mb = None
+    if returncode != 0:
+        raise RuntimeError(f"exit code {returncode}")
+    return json.loads(output), cpu_time, peak_rss_mb
+
+
+def measure(cell, input_files, repeat):
+    result = dict(cell)
+    with temp_directory(sum(os.path.getsize(input_file) for input_file in input_files)) as tmpdirname:
+        runs = [run_cell(cell, input_files, tmpdirname) for _ in range(repeat)]
+        # the fastest run is the least disturbed one
+        encodes, cpu_time, peak_rss_mb = min(runs, key=lambda run: sum(encode[2] for encode in run[0]))
+        source_size = sum(os.path.getsize(input_file) for input_file, output_file, encode_time in encodes)
+        output_size = sum(os.path.getsize(output_file) for input_file, output_file, encode_time in encodes)
+        result.update({
+            "status": "ok",
+            "files": len(encodes),
+            "encode_time": sum(encode_time for input_file, output_file, encode_time in encodes),
+            "cpu_time": cpu_time,
+            "peak_rss_mb": peak_rss_mb,
+            "source_size": source_size,
+            "output_size": output_size,
+            "ratio": source_size / output_size,
+        })
+        result.update(quality(cell, encodes))
+    return result
+
+
+def quality(cell, encodes):
+    """
+    :return: dict with mean psnr and, for images with numpy, ssim
+    """
+    values = {"psnr": [], "ssim": []}
+    for input_file, output_file, encode_time in encodes:
+        try:
+            if cell["method"] == "ffmpeg":
+                values["psnr"].append(FFMpegEnc(find_tool("ffmpeg")).psnr(input_file, output_file))
+            elif metrics is not None:
+                for name, value in metrics.compare(input_file, output_file).items():
+                    values[name].append(value)
+            else:
+                values["psnr"].append(Magick(find_tool("magick") or "magick").psnr(input_file, output_file))
+        except Exception as e:
+            print("WARNING: quality -", e, output_file)
+    return {name: sum(value) / len(value) if value and None not in value else None for name, value in values.items()}
+
+
+def compare(results, baseline):
+    """
+    :return: list of regression descriptions against the baseline results
+    """
+    baseline_cells = {cell_name(cell): cell for cell in baseline["cells"] if cell.get("status") == "ok"}
+    regressions = []
+    for cell in results["cells"]:
+        old = baseline_cells.get(cell_name(cell))
+        if old is None or cell.get("status") != "ok":
+            continue
+        name = cell_name(cell)
+        if cell["encode_time"] > old["encode_time"] * (1 + time_tolerance):
+            regressions.append(f"{name}: encode time {old['encode_time']:.2f} -> {cell['encode_time']:.2f} s")
+        if cell["ratio"] < old["ratio"] * (1 - ratio_tolerance):
+            regressions.append(f"{name}: ratio {old['ratio']:.3f} -> {cell['ratio']:.3f}")
+        if cell.get("psnr") is not None and old.get("psnr") is not None and cell["psnr"] < old["psnr"] - psnr_tolerance:
+            regressions.append(f"{name}: psnr {old['psnr']:.2f} -> {cell['psnr']:.2f}")
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Encoder benchmark over images/ and videos/")
+    parser.add_argument("-m", "--matrix", default=None, help="JSON file with a list of matrix entries, default - default_matrix")
+    parser.add_argument("-o", "--output_file", default="benchmark.json", help="Results file")
+    parser.add_argument("-b", "--baseline", default=None, help="Results file to compare with; regressions give exit code 1")
+    parser.add_argument("--filter", default=None, help="Run only cells whose name contains this text, e.g. method=avifenc")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per cell, the fastest one is kept")
+    parser.add_argument("--images", default=str(source_dir / "images"), help="Image corpus directory")
+    parser.add_argument("--videos", default=str(source_dir / "videos"), help="Video corpus directory")
+    parser.add_argument("--cell", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--output_directory", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("input_files", nargs="*", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.cell is not None:
+        print(json.dumps(encode_cell(json.loads(args.cell), args.input_files, args.output_directory)))
+        exit(0)
+
+    if args.matrix:
+        with open(args.matrix) as matrix_file:
+            matrix = json.load(matrix_file)
+    else:
+        matrix = default_matrix
+
+    image_files = sorted(glob.glob(os.path.join(args.images, "*.jpg")))
+    video_files = sorted(f for f in glob.glob(os.path.join(args.videos, "*")) if not os.path.basename(f).startswith("."))
+    results = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "machine": {"platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(), "available_cpus": available_cpus()},
+        "cells": [],
+    }
+
+    for cell in expand(matrix):
+        name = cell_name(cell)
+        if args.filter and args.filter not in name:
+            continue
+        input_files = video_files if cell["method"] == "ffmpeg" else image_files
+        reason = unavailable(cell) or (None if input_files else "no input files")
+        if reason:
+            print(f"Skip: {name} - {reason}")
+            results["cells"].append(dict(cell, status="skipped", reason=reason))
+            continue
+        print(f"Run: {name}")
+        try:
+            result = measure(cell, input_files, args.repeat)
+        except Exception as e:
+            print("ERROR (benchmark):", e, name)
+            results["cells"].append(dict(cell, status="error", reason=str(e)))
+            continue
+        results["cells"].append(result)
+        print(f"    {result['encode_time']:.2f} s, cpu {result['cpu_time'] or 0:.2f} s, rss {result['peak_rss_mb'] or 0:.0f} Mb, "
+              f"ratio {result['ratio']:.2f}, psnr {result['psnr'] or 0:.2f}")
+
+    with open(args.output_file, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results: {args.output_file}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file))
+        for regression in regressions:
+            print("REGRESSION:", regression)
+        if regressions:
+            exit(1)
+        print("No regressions")
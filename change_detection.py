@@ -0,0 +1,141 @@
+import os
+import mmap
+import hashlib
+
+from stat import S_ISREG
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+block_size = 1024 * 1024
+mmap_threshold = 64 * 1024 * 1024
+
+
+def new_hash(algorithm):
+    if algorithm == "sha256":
+        return hashlib.sha256()
+    if algorithm == "blake2b":
+        return hashlib.blake2b()
+    if algorithm == "xxh3":
+        if xxhash is None:
+            raise ValueError("xxh3 needs the xxhash module")
+        return xxhash.xxh3_128()
+    raise ValueError(f"Unknown hash algorithm - {algorithm}")
+
+
+def split_hash(value):
+    """
+    :return: algorithm, digest; values without a prefix are plain SHA-256
+    """
+    if value and ":" in value:
+        algorithm, digest = value.split(":", 1)
+        return algorithm, digest
+    return "sha256", value
+
+
+def get_hash(file_path, algorithm = "sha256"):
+    """
+    Hash of the file content; 1 MiB reads, big files are hashed from mmap.
+    Non SHA-256 hashes are prefixed with the algorithm name, e.g. "blake2b:...".
+    """
+    hash_function = new_hash(algorithm)
+    with open(file_path, "rb") as a_file:
+        size = os.fstat(a_file.fileno()).st_size
+        if size >= mmap_threshold:
+            with mmap.mmap(a_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hash_function.update(mapped)
+        else:
+            for buf in iter(lambda: a_file.read(block_size), b""):
+                hash_function.update(buf)
+    return hash_value(algorithm, hash_function)
+
+
+def hash_value(algorithm, hash_function):
+    if algorithm == "sha256":
+        return hash_function.hexdigest()
+    return f"{algorithm}:{hash_function.hexdigest()}"
+
+
+def same_content(file_path, stored_hash):
+    """
+    :return: hash of file_path with the algorithm of stored_hash, True if it matches
+    """
+    algorithm, _ = split_hash(stored_hash)
+    file_hash = get_hash(file_path, algorithm)
+    return file_hash, file_hash == stored_hash
+
+
+def scan_tree(source):
+    """
+    Walk the tree with os.scandir and yield (relative directory, [(name, stat)]).
+
+    The stat data comes from the DirEntry, so on Windows no extra system call is made
+    per file and on other systems one instead of one per attribute.
+    """
+    directories = [""]
+    while directories:
+        relative_directory = directories.pop()
+        files = []
+        try:
+            with os.scandir(os.path.join(source, relative_directory)) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(os.path.join(relative_directory, entry.name))
+                        elif entry.is_file():
+                            files.append((entry.name, entry.stat()))
+                    except OSError as e:
+                        # removed since it was listed, or no access: the other entries are still scanned
+                        print("WARNING: scan_tree -", e)
+        except OSError as e:
+            print("WARNING: scan_tree -", e)
+            continue
+        yield relative_directory, files
+
+
+def classify(record, stat):
+    """
+    :return: "skip" - dates are unchanged, "verify" - dates changed and the content has to
+        be hashed, "compress" - new file, changed size or no stored hash
+    """
+    if record is None:
+        return "compress"
+    if (record["mtime"], record["ctime"]) == (stat.st_mtime, stat.st_ctime):
+        return "skip"
+    if record["size"] is not None and record["size"] != stat.st_size:
+        return "compress"
+    if record["source_hash"]:
+        return "verify"
+    return "compress"
+
+
+def detect_changes(source, manifest):
+    """
+    Compare the scanned tree with the manifest directory by directory.
+
+    :return: generator of (relative source, stat, record, action), see classify()
+    """
+    for relative_directory, files in scan_tree(source):
+        records = manifest.directory(relative_directory)
+        for name, stat in files:
+            relative_source = os.path.join(relative_directory, name)
+            record = records.get(relative_source)
+            yield relative_source, stat, record, classify(record, stat)
+
+
+def detect_paths(source, manifest, paths):
+    """
+    detect_changes() for a list of relative paths (watch mode); paths which are gone or
+    are not regular files are left out.
+    """
+    for relative_source in paths:
+        try:
+            stat = os.stat(os.path.join(source, relative_source))
+        except OSError:
+            continue
+        if not S_ISREG(stat.st_mode):
+            continue
+        record = manifest.get(relative_source)
+        yield relative_source, stat, record, classify(record, stat)
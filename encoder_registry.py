@@ -0,0 +1,86 @@
+from resource_budget import available_cpus
+
+resources = ("cpu", "gpu", "io")
+
+registry = {}
+
+
+class Encoder:
+    """
+    One output format of a converter class.
+
+    q_range is (worst, best) quality in the encoder's own scale, so the direction is
+    known: for avifenc (63, 1) a lower value is better. threads - CPU threads of one
+    encode, None if the converter's own threads setting is used, 0 - all cores.
+    resource - what limits the encoder: "cpu", "gpu" or "io".
+    """
+
+    def __init__(self, format, function_name, q_range, extention, resource = "cpu", threads = 1) -> None:
+        if resource not in resources:
+            raise ValueError(f"Unknown resource - {resource}")
+        self.format = format
+        self.function_name = function_name
+        self.q_range = q_range
+        self.extention = extention
+        self.resource = resource
+        self.threads = threads
+        self.method = None
+
+    def thread_count(self, converter = None):
+        threads = self.threads
+        if threads is None:
+            threads = getattr(converter, "threads", 1)
+        if threads == 0:
+            threads = available_cpus()
+        return int(threads)
+
+    def throughput(self, store, settings_name = None):
+        """
+        Measured source megabytes per second from the encode result store.
+
+        :return: (number of measured encodes, MB/s) or (0, None)
+        """
+        return store.throughput(settings_name or f"{self.method}_{self.format}")
+
+    def __repr__(self):
+        return f"Encoder({self.method}, {self.format}, q{self.q_range}, {self.resource})"
+
+
+def register(converter_class):
+    """
+    Class decorator: add the encoders declared in converter_class.encoders.
+    """
+    for encoder in converter_class.encoders:
+        encoder.method = converter_class.method
+        registry[(converter_class.method, encoder.format)] = encoder
+    return converter_class
+
+
+def get_encoder(method, format):
+    return registry.get((method, format))
+
+
+def find_encoders(format = None, resource = None):
+    return [encoder for encoder in registry.values()
+            if (format is None or encoder.format == format) and (resource is None or encoder.resource == resource)]
+
+
+def fastest(format, converters, store, resource = None):
+    """
+    Pick the encoder of format with the best measured throughput.
+
+    :param converters: dict(method: converter instance) of the usable converters
+    :return: (encoder, converter); encoders without measurements come last, None if
+        no converter can write the format
+    """
+    candidates = []
+    for encoder in find_encoders(format, resource):
+        converter = converters.get(encoder.method)
+        if converter is None:
+            continue
+        count, speed = encoder.throughput(store, converter.settings_name(format))
+        candidates.append((speed is not None, speed or 0, encoder, converter))
+    if not candidates:
+        return None
+    candidates.sort(key=lambda candidate: candidate[:2], reverse=True)
+    return candidates[0][2], candidates[0][3]
@@ -0,0 +1,98 @@
+import os
+import atexit
+import threading
+import subprocess
+
+
+class ExifTool:
+    """
+    Long-lived exiftool process in "-stay_open True -@ -" mode.
+
+    Every command is written to stdin as one argument per line and finished with
+    "-execute<n>"; the answer is read from stdout up to the "{ready<n>}" marker.
+    A crashed or closed process is restarted and the command is sent once more.
+    """
+    exif_path = "exiftool"
+
+    def __init__(self, exif_path = None) -> None:
+        if exif_path:
+            self.exif_path = str(exif_path)
+        self.process = None
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [self.exif_path, "-stay_open", "True", "-@", "-", "-common_args", "-charset", "filename=utf8"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            if self.running():
+                self.process.stdin.write(b"-stay_open\nFalse\n")
+                self.process.stdin.flush()
+                self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        finally:
+            self.process = None
+
+    def _send(self, args):
+        self.counter += 1
+        ready = f"{{ready{self.counter}}}".encode()
+        lines = [str(arg) for arg in args] + [f"-execute{self.counter}", ""]
+        self.process.stdin.write("\n".join(lines).encode("utf-8"))
+        self.process.stdin.flush()
+
+        output = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise BrokenPipeError("exiftool terminated")
+            if line.rstrip(b"\r\n") == ready:
+                break
+            output.append(line)
+        return b"".join(output).decode("utf-8", errors="replace").rstrip("\r\n")
+
+    def execute(self, *args):
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if not self.running():
+                        self.start()
+                    return self._send(args)
+                except FileNotFoundError as e:
+                    print("ERROR (exiftool):", e)
+                    return ""
+                except OSError as e:
+                    print("WARNING: exiftool restart -", e)
+                    self.close()
+            return ""
+
+
+_instances = {}
+
+
+def get_exiftool(exif_path = None):
+    """
+    One ExifTool per worker process and executable; forked children start their own.
+    """
+    key = (os.getpid(), str(exif_path or ExifTool.exif_path))
+    exiftool = _instances.get(key)
+    if exiftool is None:
+        exiftool = ExifTool(exif_path)
+        _instances[key] = exiftool
+    return exiftool
+
+
+@atexit.register
+def close_all():
+    for key, exiftool in list(_instances.items()):
+        if key[0] == os.getpid():
+            exiftool.close()
+        del _instances[key]
@@ -0,0 +1,93 @@
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows: no reflinks, the read/write loop is used
+
+FICLONE = 0x40049409 # ioctl of Linux btrfs, XFS, bcachefs; the copy shares the extents
+copy_chunk = 64 * 1024 * 1024
+block_size = 1024 * 1024
+
+
+def reflink(source_fd, destination_fd):
+    """
+    :return: True if the destination now shares the blocks of the source
+    """
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(destination_fd, FICLONE, source_fd)
+        return True
+    except OSError:
+        # another filesystem, no reflink support or two filesystems
+        return False
+
+
+def kernel_copy(source_fd, destination_fd, size):
+    """
+    Copy in the kernel without reading the data into Python: copy_file_range (server
+    side copy on NFS 4.2 and SMB3 shares), sendfile otherwise.
+
+    :return: name of the system call used or None if neither works for these files
+    """
+    for name in ("copy_file_range", "sendfile"):
+        if not hasattr(os, name):
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                count = min(copy_chunk, size - offset)
+                if name == "copy_file_range":
+                    copied = os.copy_file_range(source_fd, destination_fd, count, offset, offset)
+                else:
+                    copied = os.sendfile(destination_fd, source_fd, offset, count)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            if offset:
+                raise
+            # EXDEV, ENOSYS, EINVAL - the next method starts from the beginning
+            continue
+        return name
+    return None
+
+
+def copy_file(source_path, destination_path, stat = None):
+    """
+    Copy a file with its mode and timestamps; the data is written to a .part file
+    that replaces the destination when it is complete.
+
+    :param stat: os.stat_result of the source, if it is known
+    :return: copy method - reflink, copy_file_range, sendfile or read/write
+    """
+    stat = stat or os.stat(source_path)
+    temp_path = destination_path + ".part"
+    os.makedirs(os.path.dirname(destination_path) or ".", exist_ok=True)
+    with open(source_path, "rb") as source_file, open(temp_path, "wb") as destination_file:
+        if reflink(source_file.fileno(), destination_file.fileno()):
+            method = "reflink"
+        else:
+            method = kernel_copy(source_file.fileno(), destination_file.fileno(), stat.st_size)
+        if method is None:
+            shutil.copyfileobj(source_file, destination_file, block_size)
+            method = "read/write"
+    shutil.copymode(source_path, temp_path)
+    os.utime(temp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(temp_path, destination_path)
+    return method
+
+
+def copy_directory_times(source, destination, directories):
+    """
+    Set the timestamps of the destination directories from the source ones, once after
+    all files are copied; deepest first, so a parent is not changed again afterwards.
+    """
+    for relative_directory in sorted(directories, key=lambda directory: directory.count(os.sep), reverse=True):
+        try:
+            stat = os.stat(os.path.join(source, relative_directory))
+            os.utime(os.path.join(destination, relative_directory), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        except OSError as e:
+            print("WARNING: copy_directory_times -", e)
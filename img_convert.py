@@ -1,36 +1,120 @@
 import os
+import math
+import asyncio
+import struct
+import time
 import argparse
 from posixpath import basename
 import filedate
-import shutil
-import tempfile
-import subprocess
 from pprint import pprint
-from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps
 from pathlib import Path
+from exif_tool import get_exiftool
+from result_store import EncodeResultStore, content_hash
+from temp_storage import temp_directory
+from resource_budget import available_cpus
+from encoder_registry import Encoder, register, get_encoder, registry, fastest
+from tool_runner import get_tool_runner, synchronous
+
+try:
+    import metrics
+except ImportError:
+    metrics = None
 
 source_dir = Path(__file__).resolve().parent
 
-tmp_root = r"a:"
-if os.path.exists(tmp_root):
-    tmp_dir = os.path.join(tmp_root, "tmp")
-else:
-    tmp_dir = None
+
+def reset_orientation(exif):
+    """
+    Set the Orientation tag of raw EXIF bytes to 1 (normal) in place of the old value;
+    the rest of the block, maker notes included, is kept byte for byte.
+    """
+    exif = bytearray(exif)
+    start = 6 if exif.startswith(b"Exif\x00\x00") else 0
+    order = {b"II": "<", b"MM": ">"}.get(bytes(exif[start:start + 2]))
+    if order is None or len(exif) < start + 8:
+        return bytes(exif)
+    ifd = start + struct.unpack_from(order + "I", exif, start + 4)[0]
+    if len(exif) < ifd + 2:
+        return bytes(exif)
+    for i in range(struct.unpack_from(order + "H", exif, ifd)[0]):
+        entry = ifd + 2 + i * 12
+        if len(exif) < entry + 12:
+            break
+        if struct.unpack_from(order + "H", exif, entry)[0] == 0x0112:
+            struct.pack_into(order + "H", exif, entry + 8, 1)
+            break
+    return bytes(exif)
+
+
+def read_oriented(in_file_name):
+    """
+    Decode the image once and apply its EXIF orientation in memory.
+
+    :return: image, dict(exif, xmp, icc) of the metadata to carry to the encoded file
+    """
+    with Image.open(in_file_name) as image:
+        metadata = {
+            "exif": image.info.get("exif"),
+            "xmp": image.info.get("xmp"),
+            "icc": image.info.get("icc_profile"),
+        }
+        oriented = ImageOps.exif_transpose(image)
+        if oriented is image:
+            oriented = image.copy()
+    if metadata["exif"]:
+        metadata["exif"] = reset_orientation(metadata["exif"])
+    if isinstance(metadata["xmp"], str):
+        metadata["xmp"] = metadata["xmp"].encode("utf-8")
+    return oriented, metadata
+
+
+def y4m_frame(image, yuv_format = "420"):
+    """
+    One full range BT.601 YUV4MPEG2 frame of image, chroma 4:2:0 (box filtered) or 4:4:4.
+    """
+    y, cb, cr = image.convert("RGB").convert("YCbCr").split()
+    if yuv_format == "420":
+        chroma_size = ((image.width + 1) // 2, (image.height + 1) // 2)
+        cb = cb.resize(chroma_size, Image.BOX)
+        cr = cr.resize(chroma_size, Image.BOX)
+        colorspace = "C420jpeg"
+    else:
+        colorspace = "C444"
+    header = f"YUV4MPEG2 W{image.width} H{image.height} F25:1 Ip A1:1 {colorspace} XCOLORRANGE=FULL\n"
+    return b"".join([header.encode("ascii"), b"FRAME\n", y.tobytes(), cb.tobytes(), cr.tobytes()])
 
 
 class BaseConvert:
+    method = None
+    encoders = []
     exif_path = "exiftool"
+    metadata_cache = None
+    tool_runner = None # ToolRunner, None - the shared one of the process
 
     def __init__(self, exif_path = None) -> None:
         super().__init__()
         if exif_path:
             self.exif_path = exif_path
 
+    def exiftool(self):
+        return get_exiftool(self.exif_path)
+
+    def runner(self):
+        return self.tool_runner or get_tool_runner()
+
+    async def run_tool_async(self, tool, args, **kwargs):
+        return await self.runner().run(tool, args, **kwargs)
+
+    def run_tool(self, tool, args, **kwargs):
+        return self.runner().run_sync(tool, args, **kwargs)
+
     def copy_exif(self, source_file, dest_file):
         if not (os.path.exists(source_file) and os.path.exists(dest_file)):
             return False
 
-        res = subprocess.getoutput(f'''"{self.exif_path}" -overwrite_original -TagsFromFile "{source_file}" "{dest_file}"''')  
+        res = self.exiftool().execute("-overwrite_original", "-TagsFromFile", source_file, dest_file)
         return "1 image files updated" in res
 
     def get_exif_date(self, source_file):
@@ -38,8 +122,13 @@ class BaseConvert:
         if not (os.path.exists(source_file)):
             return None
 
-        res = subprocess.getoutput(f'''"{self.exif_path}" -T -DateTimeOriginal -d "%Y.%m.%d %H:%M:%S" "{source_file}"''')  
-        if res.endswith("-"):
+        if self.metadata_cache is not None:
+            record = self.metadata_cache.get(source_file)
+            if record is not None:
+                return record["date"]
+
+        res = self.exiftool().execute("-T", "-DateTimeOriginal", "-d", "%Y.%m.%d %H:%M:%S", source_file)
+        if not res or res.endswith("-"):
             return None
 
         return res # datetime.datetime.strptime(res, "%Y.%m.%d %H:%M:%S").timestamp()
@@ -58,6 +147,33 @@ class BaseConvert:
             print("WARNING: update_file_date_from_old_file -", e)
             return self.update_file_date_from_old_file_date(source_file, dest_file)
 
+    def get_function(self, format):
+        """
+        :return: (convert function, (worst, best) quality) or (None, None) for unknown formats
+        """
+        encoder = get_encoder(self.method, format)
+        if encoder is None:
+            return None, None
+        return getattr(self, encoder.function_name), encoder.q_range
+
+    def get_async_function(self, format):
+        """
+        :return: (coroutine function of the encode, (worst, best) quality) or (None, None);
+            encoders without a tool run in a thread of the event loop
+        """
+        encoder = get_encoder(self.method, format)
+        if encoder is None:
+            return None, None
+        function = getattr(self, encoder.function_name)
+        async_function = getattr(self, encoder.function_name + "_async", None)
+        if async_function is None:
+            async def async_function(*args):
+                return await asyncio.to_thread(function, *args)
+        return async_function, encoder.q_range
+
+    def settings_name(self, format):
+        return f"{self.method}_{format}"
+
     def norm_ext(self, file_name, extentions):
         lower_extentions = map(str.lower, extentions) 
         basename, extention = os.path.splitext(file_name)
@@ -68,7 +184,13 @@ class BaseConvert:
                 return file_name + extentions[0]
         return file_name
 
+@register
 class HeicEnc(BaseConvert):
+    method = "heicenc"
+    encoders = [
+        Encoder("heic", "convert_to_heic", (0, 100), ".heic", threads=0),
+        Encoder("avif", "convert_to_avif", (0, 100), ".avif", threads=0),
+    ]
     heicenc_path = "heif-enc"
 
     def __init__(self, heicenc_path = None, exif_path = None) -> None:
@@ -76,31 +198,34 @@ class HeicEnc(BaseConvert):
         if heicenc_path:
             self.heicenc_path = heicenc_path
 
-    def convert_to_heic(self, in_file_name, out_file_name, quality):
+    async def convert_to_heic_async(self, in_file_name, out_file_name, quality):
         # quality - 0 (min) ... 100 (max)
         out_file_name = self.norm_ext(out_file_name, [".heic"])
-        subprocess.check_output(f'"{self.heicenc_path}" -q {quality} -o "{out_file_name}" "{in_file_name}"')
+        await self.run_tool_async("heicenc", [self.heicenc_path, "-q", quality, "-o", out_file_name, in_file_name])
         return out_file_name, os.path.getsize(out_file_name)
 
-    def convert_to_avif(self, in_file_name, out_file_name, quality):
+    async def convert_to_avif_async(self, in_file_name, out_file_name, quality):
         # quality - 0 (min) ... 100 (max)
         out_file_name = self.norm_ext(out_file_name, [".avif"])
-        subprocess.check_output(f'"{self.heicenc_path}" -q {quality} -A -o "{out_file_name}" "{in_file_name}"')
+        await self.run_tool_async("heicenc", [self.heicenc_path, "-q", quality, "-A", "-o", out_file_name, in_file_name])
         return out_file_name, os.path.getsize(out_file_name)
 
-    def get_function(self, format):
-        if format == "heic":
-            return self.convert_to_heic, (0, 100)
-        elif format == "avif":
-            return self.convert_to_avif, (0, 100)
-        return None        
+    convert_to_heic = synchronous(convert_to_heic_async)
+    convert_to_avif = synchronous(convert_to_avif_async)
 
 
+
+@register
 class AvifEnc(BaseConvert):
+    method = "avifenc"
+    encoders = [
+        Encoder("avif", "convert_to_avif", (63, 1), ".avif", threads=None),
+    ]
     avifenc_path = "avifenc"
     speed = 6
     codec = "aom"
     threads = 4
+    yuv_format = "420"
 
     def __init__(self, avifenc_path=None, speed=None, codec=None, threads=None, exif_path = None) -> None:
         super().__init__(exif_path)
@@ -113,26 +238,62 @@ class AvifEnc(BaseConvert):
         if threads is not None:
             self.threads = threads
 
-    def convert_to_avif(self, in_file_name, out_file_name, quality):
+    def command(self, quality):
+        return [self.avifenc_path, "--min", quality, "--max", quality, "-s", self.speed, "-c", self.codec, "-j", self.threads]
+
+    async def convert_to_avif_async(self, in_file_name, out_file_name, quality):
         # quality - 1 (max) ... 63 (min)
         # codec = aom, rav1e
         out_file_name = self.norm_ext(out_file_name, [".avif"])
-        subprocess.check_output(f'"{self.avifenc_path}" --min {quality} --max {quality} -s {self.speed} -c {self.codec} -j {self.threads} "{in_file_name}" "{out_file_name}"')
+        await self.run_tool_async("avifenc", self.command(quality) + [in_file_name, out_file_name])
+        return out_file_name, os.path.getsize(out_file_name)
+
+    async def convert_image_to_avif_async(self, image, metadata, out_file_name, quality):
+        """
+        Encode decoded pixels: a y4m frame goes to avifenc stdin, EXIF/XMP/ICC are
+        passed as avifenc options, so no exiftool run is needed afterwards.
+        """
+        out_file_name = self.norm_ext(out_file_name, [".avif"])
+        cmd = self.command(quality) + ["--stdin", "--cicp", "1/13/6"]
+        with temp_directory(sum(len(value) for value in metadata.values() if value)) as tmpdirname:
+            for name, value in metadata.items():
+                if value:
+                    metadata_file_name = os.path.join(tmpdirname, name)
+                    with open(metadata_file_name, "wb") as metadata_file:
+                        metadata_file.write(value)
+                    cmd += ["--" + name, metadata_file_name]
+            await self.run_tool_async("avifenc", cmd + [out_file_name], input=y4m_frame(image, self.yuv_format))
         return out_file_name, os.path.getsize(out_file_name)
 
+    async def convert_to_avif_oriented_async(self, in_file_name, out_file_name, quality):
+        # one decode: orientation is applied in memory, metadata is carried through
+        image, metadata = await asyncio.to_thread(read_oriented, in_file_name)
+        with image:
+            return await self.convert_image_to_avif_async(image, metadata, out_file_name, quality)
+
+    convert_to_avif = synchronous(convert_to_avif_async)
+    convert_image_to_avif = synchronous(convert_image_to_avif_async)
+    convert_to_avif_oriented = synchronous(convert_to_avif_oriented_async)
+
     def get_function(self, format, speed=None, codec=None, threads=None):
-        if format == "avif":
-            if speed is None:
-                speed = self.speed
-            if codec is None:
-                codec = self.codec
-            if threads is None:
-                threads = self.threads
-            return AvifEnc(self.avifenc_path, speed, codec, threads, self.exif_path).convert_to_avif, (63, 1)
-        return None
+        if speed is None and codec is None and threads is None:
+            return super().get_function(format)
+        return AvifEnc(self.avifenc_path, speed if speed is not None else self.speed, codec or self.codec,
+                       threads if threads is not None else self.threads, self.exif_path).get_function(format)
+
+    def settings_name(self, format):
+        return f"{self.method}_{format}_{self.codec}_{self.speed}_{self.threads}"
 
 
+@register
 class Pillow(BaseConvert):
+    method = "pil"
+    encoders = [
+        Encoder("jpeg", "convert_to_jpeg", (0, 100), ".jpg"),
+        Encoder("jpeg2000", "convert_to_jpeg2000", (100, 0), ".jp2"),
+        Encoder("webp", "convert_to_webp", (0, 100), ".webp"),
+    ]
+
     def __init__(self, exif_path = None) -> None:
         super().__init__(exif_path)
 
@@ -157,16 +318,16 @@ class Pillow(BaseConvert):
             image.save(out_file_name, format="webp", quality=int(quality), exif=image.info["exif"])
         return out_file_name, os.path.getsize(out_file_name)
 
-    def get_function(self, format):
-        if format == "jpeg":
-            return self.convert_to_jpeg, (0, 100)
-        elif format == "jpeg2000":
-            return self.convert_to_jpeg2000, (100, 0)
-        elif format == "webp":
-            return self.convert_to_webp, (0, 100)
-        return None
 
+@register
 class Magick(BaseConvert):
+    method = "magick"
+    encoders = [
+        Encoder("jpeg", "convert_to_jpeg", (1, 100), ".jpg", threads=0),
+        Encoder("jpeg2000", "convert_to_jpeg2000", (1, 100), ".jp2", threads=0),
+        Encoder("webp", "convert_to_webp", (1, 100), ".webp", threads=0),
+        Encoder("avif", "convert_to_avif", (1, 100), ".avif", threads=0),
+    ]
     magick_path = "magick"
 
     def __init__(self, magick_path = None, exif_path = None) -> None:
@@ -174,65 +335,63 @@ class Magick(BaseConvert):
         if magick_path:
             self.magick_path = magick_path
         
-    def convert_to_jpeg(self, in_file_name, out_file_name, quality):
-        # quality - 1 (min) ... 100 (max)
-        out_file_name = self.norm_ext(out_file_name, [".jpg", ".jpeg"])
-        subprocess.check_output(f'"{self.magick_path}" convert "{in_file_name}" -quality {quality} "{out_file_name}"')
+    async def convert_async(self, in_file_name, out_file_name, quality):
+        await self.run_tool_async("magick", [self.magick_path, "convert", in_file_name, "-quality", quality, out_file_name])
         return out_file_name, os.path.getsize(out_file_name)
 
-    def convert_to_jpeg2000(self, in_file_name, out_file_name, quality):
+    async def convert_to_jpeg_async(self, in_file_name, out_file_name, quality):
+        # quality - 1 (min) ... 100 (max)
+        return await self.convert_async(in_file_name, self.norm_ext(out_file_name, [".jpg", ".jpeg"]), quality)
+
+    async def convert_to_jpeg2000_async(self, in_file_name, out_file_name, quality):
         # quality - 1 (max) ... n (compsession scale factor)
-        out_file_name = self.norm_ext(out_file_name, [".jp2"])
-        subprocess.check_output(f'"{self.magick_path}" convert "{in_file_name}" -quality {quality} "{out_file_name}"')
-        return out_file_name, os.path.getsize(out_file_name)
-    
-    def convert_to_avif(self, in_file_name, out_file_name, quality):
-        out_file_name = self.norm_ext(out_file_name, [".avif"])
-        subprocess.check_output(f'"{self.magick_path}" convert "{in_file_name}" -quality {quality} "{out_file_name}"')
-        return out_file_name, os.path.getsize(out_file_name)
+        return await self.convert_async(in_file_name, self.norm_ext(out_file_name, [".jp2"]), quality)
 
-    def convert_to_webp(self, in_file_name, out_file_name, quality):
-        # quality - 0 (min) ... 100 (max)
-        out_file_name = self.norm_ext(out_file_name, [".webp"])
-        subprocess.check_output(f'"{self.magick_path}" convert "{in_file_name}" -quality {quality} "{out_file_name}"')
-        return out_file_name, os.path.getsize(out_file_name)
+    async def convert_to_avif_async(self, in_file_name, out_file_name, quality):
+        return await self.convert_async(in_file_name, self.norm_ext(out_file_name, [".avif"]), quality)
 
-    def get_function(self, format):
-        if format == "jpeg":
-            return self.convert_to_jpeg, (1, 100)
-        elif format == "jpeg2000":
-            return self.convert_to_jpeg2000, (1, 100)
-        elif format == "webp":
-            return self.convert_to_webp, (1, 100)
-        elif format == "avif":
-            return self.convert_to_avif, (1, 100)
-        return None
+    async def convert_to_webp_async(self, in_file_name, out_file_name, quality):
+        # quality - 0 (min) ... 100 (max)
+        return await self.convert_async(in_file_name, self.norm_ext(out_file_name, [".webp"]), quality)
 
-    def auto_orient(self, in_file_name, out_file_name):
-        subprocess.check_output(f'"{self.magick_path}" "{in_file_name}" -auto-orient "{out_file_name}"')
+    async def auto_orient_async(self, in_file_name, out_file_name):
+        await self.run_tool_async("magick", [self.magick_path, in_file_name, "-auto-orient", out_file_name])
         return os.path.exists(out_file_name)
-                    
+
+    convert_to_jpeg = synchronous(convert_to_jpeg_async)
+    convert_to_jpeg2000 = synchronous(convert_to_jpeg2000_async)
+    convert_to_avif = synchronous(convert_to_avif_async)
+    convert_to_webp = synchronous(convert_to_webp_async)
+    auto_orient = synchronous(auto_orient_async)
+
     def psnr(self, original_file_name, test_file_name):
-        with tempfile.TemporaryDirectory(prefix=tmp_dir) as tmpdirname:
-            res = subprocess.getoutput(f'''"{self.magick_path}" compare -metric PSNR "{original_file_name}" "{test_file_name}" "{os.path.join(tmpdirname, 'tmp.png')}''')
+        if metrics is not None:
+            try:
+                return metrics.psnr(original_file_name, test_file_name)
+            except Exception as e:
+                print("WARNING: metrics.psnr -", e)
+        return self.psnr_magick(original_file_name, test_file_name)
+
+    def psnr_magick(self, original_file_name, test_file_name):
+        # the difference image is a PNG of about the size of the decoded original
+        with temp_directory(os.path.getsize(original_file_name) * 4) as tmpdirname:
+            # compare exits with 1 when the images differ, the value is on stderr
+            res = self.run_tool("magick", [self.magick_path, "compare", "-metric", "PSNR", original_file_name, test_file_name,
+                                           os.path.join(tmpdirname, "tmp.png")], check=False).stderr.decode(errors="replace")
             try:
-                res = float(res)
-                return res
+                return float(res.split()[0])
             except Exception as e:
                 print(e, res)
-                shutil.copy(test_file_name, os.getcwd()) 
                 return None
 
-def optimizer(method_format_name, convert, if_file_name, min_q, max_q, target_ratio):
+def optimizer(method_format_name, convert, if_file_name, min_q, max_q, target_ratio, store=None):
     print("Optimize:", method_format_name, if_file_name, min_q, max_q, target_ratio)
     result = None
-    if os.path.exists("cache.dat"):
-        with open("cache.dat") as f:
-            cache = eval(f.readline())
-    else:
-        cache = dict()
-        
-    with tempfile.TemporaryDirectory(prefix=tmp_dir) as tmpdirname:
+    if store is None:
+        store = EncodeResultStore()
+    source_hash = content_hash(if_file_name)
+
+    with temp_directory(os.path.getsize(if_file_name)) as tmpdirname:
         input_file_size = os.path.getsize(if_file_name)
         tmp_file = os.path.join(tmpdirname, "tmp")
         med_q = (max_q + min_q) // 2
@@ -243,19 +402,19 @@ def optimizer(method_format_name, convert, if_file_name, min_q, max_q, target_ra
         min_distance = 1000
 
         while True:
-            key = (method_format_name, if_file_name, med_q)
-            cached = False
-            if key in cache:
-                cached = True
-                value = cache[key]
+            stored = store.get(source_hash, method_format_name, med_q)
+            cached = stored is not None
+            if cached:
+                value = stored["size"]
             else:
                 try:
+                    encode_start = time.time()
                     value = convert(if_file_name, tmp_file, med_q)[1]
                 except Exception as e:
                     print(e, if_file_name, tmp_file, med_q)
                     raise
 
-                cache[key] = value
+                store.put(source_hash, method_format_name, med_q, value, time.time() - encode_start, source_size=input_file_size)
 
             med_q_result = input_file_size / value
             print(f"f({med_q:2.2f}) = {med_q_result:2.2f}{', cached' if cached else ''}")
@@ -277,28 +436,182 @@ def optimizer(method_format_name, convert, if_file_name, min_q, max_q, target_ra
 
             if med_q_old == med_q:
                 break
-    
-    with open("cache.dat", "w") as f:
-        f.write(str(cache))
 
     print("Optimization result is:", opt_q, "distance:", min_distance)
     return opt_q
 
 
+def interpolate_quality(q_a, ratio_a, q_b, ratio_b, target_ratio):
+    # log(ratio) is close to linear in quality between two neighbouring samples
+    if ratio_a == ratio_b:
+        return (q_a + q_b) / 2
+    return q_a + (math.log(ratio_a) - math.log(target_ratio)) * (q_b - q_a) / (math.log(ratio_a) - math.log(ratio_b))
+
+
+def next_quality(samples, min_q, max_q, target_ratio, widths, tolerance):
+    """
+    Next quality to probe for target_ratio or None if the samples already answer it.
+
+    The ratio falls monotonically from min_q to max_q. Inside a bracket the step is
+    interpolated on log(ratio), outside of it the two nearest samples are extrapolated,
+    and bisection takes over if the bracket does not halve every two steps.
+    """
+    if any(abs(ratio - target_ratio) <= tolerance * target_ratio for ratio in samples.values()):
+        return None
+
+    direction = 1 if max_q > min_q else -1
+    ordered = sorted(samples, key=lambda q: (q - min_q) * direction)
+    higher = [q for q in ordered if samples[q] > target_ratio]
+    lower = [q for q in ordered if samples[q] <= target_ratio]
+    q_a = higher[-1] if higher else min_q
+    q_b = lower[0] if lower else max_q
+    if abs(q_b - q_a) <= 1:
+        return None
+
+    if higher and lower:
+        q = interpolate_quality(q_a, samples[q_a], q_b, samples[q_b], target_ratio)
+    elif len(higher) >= 2:
+        q = interpolate_quality(higher[-2], samples[higher[-2]], q_a, samples[q_a], target_ratio)
+    elif len(lower) >= 2:
+        q = interpolate_quality(q_b, samples[q_b], lower[1], samples[lower[1]], target_ratio)
+    else:
+        q = (q_a + q_b) // 2
+
+    widths.append(abs(q_b - q_a))
+    if len(widths) >= 3 and widths[-1] > widths[-3] / 2:
+        q = (q_a + q_b) // 2
+
+    low_q, high_q = sorted((q_a, q_b))
+    return min(max(round(q), low_q + 1), high_q - 1)
+
+
+def search_qualities(method_format_name, convert, if_file_name, min_q, max_q, target_ratios, store=None, tolerance=0.02, max_rounds=20):
+    """
+    Find quality values for several target ratios at once, sharing encodes between them.
+
+    A target is resolved when the next quality is already sampled (the curve is not
+    monotonic there) or after max_rounds rounds; the closest sample is its result.
+
+    :return: dict(target_ratio: quality)
+    """
+    print("Optimize:", method_format_name, if_file_name, min_q, max_q, target_ratios)
+    if store is None:
+        store = EncodeResultStore()
+    source_hash = content_hash(if_file_name)
+    input_file_size = os.path.getsize(if_file_name)
+    samples = {}
+
+    with temp_directory(input_file_size) as tmpdirname:
+        tmp_file = os.path.join(tmpdirname, "tmp")
+        widths = {target_ratio: [] for target_ratio in target_ratios}
+        resolved = set()
+        rounds = 0
+        while len(resolved) < len(target_ratios):
+            rounds += 1
+            probes = set()
+            for target_ratio in target_ratios:
+                if target_ratio in resolved:
+                    continue
+                q = next_quality(samples, min_q, max_q, target_ratio, widths[target_ratio], tolerance)
+                if q is None or q in samples or rounds > max_rounds:
+                    resolved.add(target_ratio)
+                else:
+                    probes.add(q)
+
+            for q in sorted(probes):
+                stored = store.get(source_hash, method_format_name, q)
+                cached = stored is not None
+                if cached:
+                    value = stored["size"]
+                else:
+                    try:
+                        encode_start = time.time()
+                        value = convert(if_file_name, tmp_file, q)[1]
+                    except Exception as e:
+                        print(e, if_file_name, tmp_file, q)
+                        raise
+                    store.put(source_hash, method_format_name, q, value, time.time() - encode_start, source_size=input_file_size)
+
+                samples[q] = input_file_size / value
+                print(f"f({q:2.2f}) = {samples[q]:2.2f}{', cached' if cached else ''}")
+
+    result = {}
+    for target_ratio in target_ratios:
+        result[target_ratio] = min(samples, key=lambda q: abs(samples[q] - target_ratio))
+        print("Optimization result is:", result[target_ratio], "for ratio", target_ratio,
+              "distance:", abs(samples[result[target_ratio]] - target_ratio))
+    print("Encodes:", len(samples))
+    return result
+
+
+def optimize_file(search, method_format_name, convert, input_file, q_range, ratios, cache_file):
+    store = EncodeResultStore(cache_file)
+    if search == "model":
+        return search_qualities(method_format_name, convert, input_file, q_range[0], q_range[1], ratios, store)
+    return {j: optimizer(method_format_name, convert, input_file, q_range[0], q_range[1], j, store) for j in ratios}
+
+
+def evaluate_quality(method_format_name, convert, input_file, q, cache_file, psnr):
+    store = EncodeResultStore(cache_file)
+    source_hash = content_hash(input_file)
+    stored = store.get(source_hash, method_format_name, q)
+    if stored is not None and stored["psnr"] is not None:
+        print(input_file, q, stored["psnr"], "cached")
+        return stored["psnr"]
+
+    with temp_directory(os.path.getsize(input_file)) as tmpdirname:
+        encode_start = time.time()
+        tmp_output_file, tmp_output_size = convert(input_file, os.path.join(tmpdirname, "tmp"), q)
+        encode_time = time.time() - encode_start
+        _psnr = psnr(input_file, tmp_output_file)
+    store.put(source_hash, method_format_name, q, tmp_output_size, encode_time, _psnr, os.path.getsize(input_file))
+    print(input_file, q, _psnr)
+    return _psnr
+
+
+async def convert_files_async(convert, jobs):
+    """
+    Run every (input file, output file, quality) job of one async convert function at once
+    from this event loop; the tool semaphores of the runner limit the running encoders.
+
+    :return: (output file, size) or the exception of every job, in the order of jobs
+    """
+    return await asyncio.gather(*(convert(*job) for job in jobs), return_exceptions=True)
+
+
+def run_tasks(function, tasks, jobs):
+    """
+    Run function(*task) for every task, in a process pool if jobs > 1.
+
+    :return: results in the order of tasks, whatever the completion order is
+    """
+    if jobs <= 1:
+        return [function(*task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(function, *task) for task in tasks]
+        return [future.result() for future in futures]
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument("method", choices=["pil", "magick", "heicenc", "avifenc", "psnr"], help="pil, magick, heicenc, avifenc")
+    parser.add_argument("method", choices=["pil", "magick", "heicenc", "avifenc", "psnr", "encoders"], help="pil, magick, heicenc, avifenc; encoders - list the registered encoders with measured throughput")
     parser.add_argument("-f", "--format", default=None, help="""For 'pil' method - jpeg, jpeg2000, webp;
 For 'magick' method - jpeg, jpeg2000, webp, avif;
 For 'heicenc' method - avif, heic;
 For 'avifenc' method - avif.""")
-    parser.add_argument("-i", "--input_file", default=None, help="Input file name with path")
-    parser.add_argument("-o", "--output_file", default="result", help="Output file name with path with or without extention")
+    parser.add_argument("-i", "--input_file", default=None, help="Input file name with path, or a directory - all its files are converted at once")
+    parser.add_argument("-o", "--output_file", default="result", help="Output file name with path with or without extention, the output directory for an input directory")
     parser.add_argument("-q", "--quality_level", default=32, help="Quality of encoding")
     parser.add_argument("-c", "--codec", choices=["aom", "rav1e"], default="aom", help="Optional codec selection for 'avifenc' method - aom, rav1e")
     parser.add_argument("-s", "--speed", choices=list(map(str, range(0, 11))), default="6", help="Optional speed selection for 'avifenc' method - integer value in [0..10], 0 is slowest and 10 is fastest")
     parser.add_argument("-t", "--threads", choices=list(map(str, range(0, 33))), default="8", help="Number of parallel CPU threads for 'avifenc' method - integer value in [0..32]")
+    parser.add_argument("--ms_ssim", action="store_true", help="Also compute MS-SSIM for 'psnr' method")
     parser.add_argument("--optimize", default=None, help="Find a quality value for 2, 3, 4 ratios")
+    parser.add_argument("--search", choices=["model", "bisect"], default="model", help="Quality search for --optimize: 'model' interpolates on shared samples for all ratios, 'bisect' runs a bisection per ratio")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Parallel encodes for --optimize, 0 - as many as fit the CPU cores with the encoder threads")
+    parser.add_argument("--cache_file", default="cache.db", help="Encode result store used by --optimize")
+    parser.add_argument("--cache_max_entries", type=int, default=None, help="Keep at most this many results in the store")
+    parser.add_argument("--cache_max_age", type=float, default=None, help="Drop results unused for this many days")
     return parser.parse_args()
 
 
@@ -313,6 +626,25 @@ if __name__ == "__main__":
     output_file_size = None
     output_file_name = None
 
+    converter = None
+    if args.method == "encoders":
+        import video_convert  # noqa: F401 - registers the video encoders
+        store = EncodeResultStore(args.cache_file)
+        # results are stored per settings name, e.g. avifenc_avif_aom_6_8 - as set by the options
+        converters = {"pil": Pillow(exiftool_path), "magick": Magick(magick_path, exiftool_path),
+                      "heicenc": HeicEnc(heicenc_path, exiftool_path),
+                      "avifenc": AvifEnc(avifenc_path, args.speed, args.codec, args.threads, exiftool_path),
+                      "ffmpeg": video_convert.FFMpegEnc(exif_path=exiftool_path)}
+        for (method, format), encoder in registry.items():
+            count, speed = encoder.throughput(store, converters[method].settings_name(format))
+            speed = f"{speed:.2f} MB/s ({count} encodes)" if speed is not None else "not measured"
+            print(f"{method:8} {format:10} q {encoder.q_range[0]}..{encoder.q_range[1]} {encoder.resource:3} threads {'as set' if encoder.threads is None else encoder.threads or 'all'}, {speed}")
+        for format in sorted({format for method, format in registry}):
+            encoder, converter = fastest(format, converters, store)
+            if encoder.throughput(store, converter.settings_name(format))[1] is not None:
+                print(f"fastest {format}: {encoder.method}")
+        exit(0)
+
     # format_name = args.format
     if args.method == "pil":
         converter = Pillow(exiftool_path)
@@ -329,8 +661,13 @@ if __name__ == "__main__":
         exit(1)
 
     if args.method == "psnr":
-        psnr = converter.psnr(args.input_file, args.output_file)
-        print(f"psnr: {psnr}")
+        if metrics is not None:
+            names = ["psnr", "ssim"] + (["ms_ssim"] if args.ms_ssim else [])
+            for name, value in metrics.compare(args.input_file, args.output_file, names).items():
+                print(f"{name}: {value}")
+        else:
+            psnr = converter.psnr(args.input_file, args.output_file)
+            print(f"psnr: {psnr}")
     elif args.optimize is not None:
         test_files_count = 9
 
@@ -340,40 +677,78 @@ if __name__ == "__main__":
             exit(1)            
 
         ratios = [2, 3, 4] 
-        method_format_name = f"{args.method}_{args.format}"
-        if args.method == "avifenc":
-            method_format_name = f"{method_format_name}_{args.codec}_{args.speed}_{args.threads}"
+        method_format_name = converter.settings_name(args.format)
+
+        store = EncodeResultStore(args.cache_file)
+        imported = store.import_legacy()
+        if imported:
+            print(f"Imported {imported} results from cache.dat")
+
+        # registry: e.g. magick uses all cores, avifenc its -j setting
+        encoder_threads = max(get_encoder(converter.method, args.format).thread_count(converter), 1)
+        jobs = args.jobs if args.jobs > 0 else max(available_cpus() // encoder_threads, 1)
+        print(f"Jobs: {jobs}, encoder threads: {encoder_threads}")
+        input_files = [f"images\\{i}.jpg" for i in range(1, test_files_count+1)]
+
+        file_qualities = run_tasks(optimize_file, [
+            (args.search, method_format_name, converter_function, input_file, q_range, ratios, args.cache_file)
+            for input_file in input_files], jobs)
 
         results = {}
-        for i in range(1, test_files_count+1):
+        for qualities in file_qualities:
             for j in ratios:
                 if j not in results:
                     results[j] = 0
-                results[j] += optimizer(method_format_name, converter_function, f"images\\{i}.jpg", q_range[0], q_range[1], j)
+                results[j] += qualities[j]
 
         psnr = Magick(magick_path).psnr
 
         for j in ratios:
             results[j] = round(results[j] / test_files_count)
-            
-        psnr_value = {}
-        with tempfile.TemporaryDirectory(prefix=tmp_dir) as tmpdirname:            
-            tmp_result_path = os.path.join(tmpdirname, "tmp")
-            for i in range(1, test_files_count+1):
-                input_file = f"images\\{i}.jpg"
-                for j, q in results.items(): 
-                    if j not in psnr_value:
-                        psnr_value[j] = [0, 0]
-                    tmp_output_file, _ = converter_function(input_file, tmp_result_path, q)
-                    _psnr = psnr(input_file, tmp_output_file)
-                    print(input_file, tmp_output_file, _psnr)
-                    if _psnr is not None:
-                        psnr_value[j][0] += _psnr
-                        psnr_value[j][1] += 1
 
-        
+        tasks = [(input_file, j) for input_file in input_files for j in results]
+        file_psnr = run_tasks(evaluate_quality, [
+            (method_format_name, converter_function, input_file, results[j], args.cache_file, psnr)
+            for input_file, j in tasks], jobs)
+
+        psnr_value = {j: [0, 0] for j in results}
+        for (input_file, j), _psnr in zip(tasks, file_psnr):
+            if _psnr is not None:
+                psnr_value[j][0] += _psnr
+                psnr_value[j][1] += 1
+
         for j, q in results.items(): 
             print(f"Mean q for ratio {j} is {q}, psnr is {psnr_value[j][0] / psnr_value[j][1]:2.2f}")
+
+        if args.cache_max_entries is not None or args.cache_max_age is not None:
+            removed = store.evict(args.cache_max_entries, args.cache_max_age)
+            print(f"Evicted {removed} results from {args.cache_file}")
+    elif os.path.isdir(args.input_file):
+        converter_function, q_range = converter.get_async_function(args.format)
+        if converter_function is None:
+            print(f"Unknown format - {args.format}")
+            exit(1)
+
+        os.makedirs(args.output_file, exist_ok=True)
+        input_files = sorted(os.path.join(args.input_file, file_name) for file_name in os.listdir(args.input_file)
+                             if os.path.isfile(os.path.join(args.input_file, file_name)))
+        jobs = [(input_file, os.path.join(args.output_file, os.path.splitext(os.path.basename(input_file))[0]), args.quality_level)
+                for input_file in input_files]
+        start_time = time.time()
+        results = asyncio.run(convert_files_async(converter_function, jobs))
+        input_files_size = output_files_size = 0
+        for input_file, result in zip(input_files, results):
+            if isinstance(result, Exception):
+                print("ERROR (conversion):", result, input_file)
+                continue
+            output_file_name, output_file_size = result
+            converter.copy_exif(input_file, output_file_name)
+            converter.update_file_date_from_old_file(input_file, output_file_name)
+            input_files_size += os.path.getsize(input_file)
+            output_files_size += output_file_size
+        if output_files_size:
+            print(f"Files: {len(input_files)}, Input size: {input_files_size}, Output size: {output_files_size}, "
+                  f"Ratio: {input_files_size/output_files_size:2.2f}, {time.time() - start_time:.2f} s")
     else:
         input_file_size = os.path.getsize(args.input_file)
         converter_function, q_range = converter.get_function(args.format)
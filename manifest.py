@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import sqlite3
+
+manifest_name = ".manifest.db"
+fields = ["path", "size", "mtime", "ctime", "source_hash", "archive_hash", "volumes", "encoder", "member"]
+
+
+def read_hash_file(hash_file_path):
+    if not os.path.exists(hash_file_path):
+        return "", "", None, None
+
+    with open(hash_file_path, "r") as hash_file:
+        lines = hash_file.readlines()
+    hash_line = lines[0].strip()
+    div_position = len(hash_line) // 2
+    hash_source_file = hash_line[:div_position]
+    hash_archive_file = hash_line[div_position:]
+    if len(lines) >= 3:
+        mtime_source_file = lines[1].strip()
+        ctime_source_file = lines[2].strip()
+    else:
+        mtime_source_file = None
+        ctime_source_file = None
+    return hash_source_file, hash_archive_file, mtime_source_file, ctime_source_file
+
+
+class Manifest:
+    """
+    Backup state of one destination in a single SQLite database.
+
+    One record per source file (path relative to the source root): size, mtime, ctime,
+    source and archive hashes, archive volumes relative to the destination, the
+    encoder settings and, for files packed with others, the member name in the archive. Records of a directory are read with one query; writes are
+    collected and committed in batches by the coordinating process.
+    """
+
+    def __init__(self, destination, batch_size = 500) -> None:
+        self.destination = destination
+        self.db_path = os.path.join(destination, manifest_name)
+        self.batch_size = batch_size
+        self.changes = []
+        self.last_commit = time.time()
+        self.connection = sqlite3.connect(self.db_path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, directory TEXT, size INTEGER, mtime REAL, ctime REAL,
+            source_hash TEXT, archive_hash TEXT, volumes TEXT, encoder TEXT, updated REAL, member TEXT)""")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+        if "member" not in columns:
+            self.connection.execute("ALTER TABLE files ADD COLUMN member TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_directory ON files (directory)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_source_hash ON files (source_hash)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def _record(self, row):
+        record = dict(zip(fields, row))
+        record["volumes"] = json.loads(record["volumes"] or "[]")
+        return record
+
+    def get(self, path):
+        self.flush()
+        row = self.connection.execute(f"SELECT {', '.join(fields)} FROM files WHERE path = ?", (path, )).fetchone()
+        return None if row is None else self._record(row)
+
+    def find_hash(self, source_hash):
+        """
+        :return: a record with archive volumes for this content or None
+        """
+        for change in reversed(self.changes):
+            if change[5] == source_hash and change[7] != "[]":
+                return self._record((change[0], ) + change[2:9] + change[10:])
+        row = self.connection.execute(
+            f"SELECT {', '.join(fields)} FROM files WHERE source_hash = ? AND volumes != '[]' LIMIT 1", (source_hash, )).fetchone()
+        return None if row is None else self._record(row)
+
+    def directory(self, directory):
+        """
+        :return: dict(path: record) for all files of one source directory
+        """
+        self.flush()
+        rows = self.connection.execute(f"SELECT {', '.join(fields)} FROM files WHERE directory = ?", (directory, ))
+        return {row[0]: self._record(row) for row in rows}
+
+    def put(self, record):
+        self.changes.append((
+            record["path"], os.path.dirname(record["path"]), record.get("size"), record.get("mtime"), record.get("ctime"),
+            record.get("source_hash"), record.get("archive_hash"), json.dumps(record.get("volumes") or []),
+            record.get("encoder"), time.time(), record.get("member")))
+        if len(self.changes) >= self.batch_size or time.time() - self.last_commit > 10:
+            self.flush()
+
+    def update_dates(self, path, mtime, ctime):
+        record = self.get(path)
+        if record is not None:
+            record["mtime"] = mtime
+            record["ctime"] = ctime
+            self.put(record)
+
+    def flush(self):
+        if self.changes:
+            with self.connection:
+                self.connection.executemany(
+                    """INSERT OR REPLACE INTO files (path, directory, size, mtime, ctime, source_hash, archive_hash,
+                    volumes, encoder, updated, member) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", self.changes)
+            self.changes = []
+        self.last_commit = time.time()
+
+    def import_hash_files(self, remove = False):
+        """
+        Import the per-file .hash sidecars written by older versions.
+
+        :return: number of imported records
+        """
+        imported = 0
+        for root, dirs, files in os.walk(self.destination):
+            for i_file in files:
+                if not i_file.endswith(".hash"):
+                    continue
+                hash_path = os.path.join(root, i_file)
+                archive_path = hash_path[:-len(".hash")] + ".7z"
+                if os.path.exists(archive_path):
+                    volumes = [archive_path]
+                else:
+                    volumes = []
+                    while os.path.exists(f"{archive_path}.{len(volumes) + 1:03d}"):
+                        volumes.append(f"{archive_path}.{len(volumes) + 1:03d}")
+                if not volumes:
+                    continue
+
+                hash_source_file, hash_archive_file, mtime_source_file, ctime_source_file = read_hash_file(hash_path)
+                self.put({
+                    "path": os.path.relpath(hash_path[:-len(".hash")], self.destination),
+                    "mtime": float(mtime_source_file) if mtime_source_file else None,
+                    "ctime": float(ctime_source_file) if ctime_source_file else None,
+                    "source_hash": hash_source_file,
+                    "archive_hash": hash_archive_file,
+                    "volumes": [os.path.relpath(volume, self.destination) for volume in volumes],
+                })
+                if remove:
+                    os.remove(hash_path)
+                imported += 1
+        self.flush()
+        return imported
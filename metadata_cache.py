@@ -0,0 +1,139 @@
+import os
+import json
+import sqlite3
+
+from exif_tool import get_exiftool
+
+date_format = "%Y.%m.%d %H:%M:%S"
+prescan_extentions = [".jpg", ".jpeg", ".heic", ".png", ".mp4", ".mkv", ".mov"]
+
+
+class MetadataCache:
+    """
+    Capture date, orientation, dimensions and MIME type of source files.
+
+    Records are keyed by normalized path and are only returned while the file
+    mtime and size are unchanged. With db_path = None the cache lives in memory only,
+    otherwise it is a SQLite database that several worker processes may read.
+    """
+
+    def __init__(self, db_path = None) -> None:
+        self.db_path = db_path
+        self.records = {}
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        if self.db_path is None:
+            return None
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS metadata (
+                path TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+                date TEXT, orientation INTEGER, width INTEGER, height INTEGER, mime TEXT)""")
+            self.pid = os.getpid()
+        return self.connection
+
+    def get(self, path):
+        path = os.path.normpath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        record = self.records.get(path)
+        if record is None and self.connect() is not None:
+            row = self.connection.execute(
+                "SELECT mtime, size, date, orientation, width, height, mime FROM metadata WHERE path = ?", (path, )).fetchone()
+            if row is not None:
+                record = dict(zip(("mtime", "size", "date", "orientation", "width", "height", "mime"), row))
+                self.records[path] = record
+
+        if record is None or record["mtime"] != stat.st_mtime or record["size"] != stat.st_size:
+            return None
+        return record
+
+    def put_many(self, records):
+        self.records.update(records)
+        if self.connect() is None:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(path, r["mtime"], r["size"], r["date"], r["orientation"], r["width"], r["height"], r["mime"])
+                 for path, r in records.items()])
+
+    def load(self):
+        if self.connect() is None:
+            return
+        for row in self.connection.execute("SELECT * FROM metadata"):
+            self.records[row[0]] = dict(zip(("mtime", "size", "date", "orientation", "width", "height", "mime"), row[1:]))
+
+    def prescan(self, directory, exif_path = None, batch_size = 10000, files = None):
+        """
+        Read the metadata of a directory tree with a few batched exiftool calls.
+
+        An empty cache is filled by one recursive call, otherwise only the files
+        which are new or changed since the last scan are read, batch_size per call.
+
+        :param files: relative paths to read instead of the whole tree
+        :return: number of files added to the cache
+        """
+        self.load()
+        whole_tree = files is None
+        if whole_tree:
+            files = [os.path.join(root, i_file) for root, dirs, i_files in os.walk(directory) for i_file in i_files]
+        else:
+            files = [os.path.join(directory, i_file) for i_file in files]
+        paths = []
+        total_count = 0
+        for i_file in files:
+            if os.path.splitext(i_file)[1].lower() in prescan_extentions:
+                total_count += 1
+                path = os.path.normpath(i_file)
+                if self.get(path) is None:
+                    paths.append(path)
+
+        if not paths:
+            return 0
+        if len(paths) == total_count and whole_tree:
+            return self.read(["-r", directory], exif_path)
+
+        files_count = 0
+        for i in range(0, len(paths), batch_size):
+            files_count += self.read(paths[i:i + batch_size], exif_path)
+        return files_count
+
+    def read(self, targets, exif_path = None):
+        args = ["-json", "-q", "-q", "-d", date_format,
+                "-DateTimeOriginal", "-Orientation#", "-ImageWidth", "-ImageHeight", "-MIMEType"]
+        for extention in prescan_extentions:
+            args.extend(["-ext", extention[1:]])
+        args.extend(targets)
+
+        res = get_exiftool(exif_path).execute(*args)
+        try:
+            items = json.loads(res[res.index("["):res.rindex("]") + 1])
+        except ValueError:
+            items = []
+
+        records = {}
+        for item in items:
+            path = os.path.normpath(item["SourceFile"])
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            date = item.get("DateTimeOriginal")
+            records[path] = {
+                "mtime": stat.st_mtime,
+                "size": stat.st_size,
+                "date": date if isinstance(date, str) and date != "-" else None,
+                "orientation": item.get("Orientation"),
+                "width": item.get("ImageWidth"),
+                "height": item.get("ImageHeight"),
+                "mime": item.get("MIMEType"),
+            }
+        self.put_many(records)
+        return len(records)
@@ -0,0 +1,156 @@
+import math
+import numpy as np
+
+from PIL import Image
+
+try:
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+    if hasattr(pillow_heif, "register_avif_opener"):
+        pillow_heif.register_avif_opener()
+except ImportError:
+    pass
+
+try:
+    import pillow_avif  # noqa: F401 - registers the AVIF plugin
+except ImportError:
+    pass
+
+tile_rows = 512
+ms_ssim_weights = [0.0448, 0.2856, 0.3001, 0.2363, 0.1333]
+
+_window = np.exp(-0.5 * ((np.arange(11, dtype=np.float32) - 5) / 1.5) ** 2)
+_window /= _window.sum()
+_c1 = (0.01 * 255) ** 2
+_c2 = (0.03 * 255) ** 2
+
+
+def load_image(file_name):
+    """
+    Decode an image once into a uint8 array (height, width, channels).
+    """
+    with Image.open(file_name) as image:
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        return np.asarray(image)
+
+
+def _pixels(image):
+    if isinstance(image, np.ndarray):
+        return image
+    return load_image(image)
+
+
+def _pair(original, test):
+    x = _pixels(original)
+    y = _pixels(test)
+    if x.ndim != y.ndim:
+        x = x if x.ndim == 3 else np.stack([x] * 3, axis=-1)
+        y = y if y.ndim == 3 else np.stack([y] * 3, axis=-1)
+    if x.shape != y.shape:
+        raise ValueError(f"Image sizes differ: {x.shape} and {y.shape}")
+    return x, y
+
+
+def _luma(pixels, start, stop):
+    rows = pixels[start:stop].astype(np.float32)
+    if rows.ndim == 2:
+        return rows
+    return rows[..., 0] * 0.299 + rows[..., 1] * 0.587 + rows[..., 2] * 0.114
+
+
+def _filter(a):
+    # separable 11x11 gaussian, only the fully covered ("valid") part
+    n = len(_window)
+    rows = sum(w * a[i:a.shape[0] - n + 1 + i] for i, w in enumerate(_window))
+    return sum(w * rows[:, i:rows.shape[1] - n + 1 + i] for i, w in enumerate(_window))
+
+
+def _ssim_cs(x, y, rows):
+    """
+    Mean SSIM and mean contrast-structure term over the luma of x and y, rows per strip.
+    """
+    height = x.shape[0]
+    pad = len(_window) - 1
+    if height <= pad or x.shape[1] <= pad:
+        raise ValueError(f"Image is too small for SSIM: {x.shape}")
+
+    ssim_sum = 0.0
+    cs_sum = 0.0
+    count = 0
+    for start in range(0, height - pad, rows):
+        stop = min(start + rows + pad, height)
+        a = _luma(x, start, stop)
+        b = _luma(y, start, stop)
+        mu_a = _filter(a)
+        mu_b = _filter(b)
+        sigma_a = _filter(a * a) - mu_a * mu_a
+        sigma_b = _filter(b * b) - mu_b * mu_b
+        sigma_ab = _filter(a * b) - mu_a * mu_b
+        cs = (2 * sigma_ab + _c2) / (sigma_a + sigma_b + _c2)
+        ssim_map = (2 * mu_a * mu_b + _c1) / (mu_a * mu_a + mu_b * mu_b + _c1) * cs
+        ssim_sum += float(ssim_map.sum(dtype=np.float64))
+        cs_sum += float(cs.sum(dtype=np.float64))
+        count += cs.size
+    return ssim_sum / count, cs_sum / count
+
+
+def _downsample(pixels, rows):
+    height = pixels.shape[0] // 2 * 2
+    width = pixels.shape[1] // 2 * 2
+    result = np.empty((height // 2, width // 2), dtype=np.float32)
+    rows = max(rows // 2 * 2, 2)
+    for start in range(0, height, rows):
+        stop = min(start + rows, height)
+        a = _luma(pixels, start, stop)[:, :width]
+        result[start // 2:stop // 2] = (a[0::2, 0::2] + a[1::2, 0::2] + a[0::2, 1::2] + a[1::2, 1::2]) / 4
+    return result
+
+
+def psnr(original, test, rows = None):
+    """
+    PSNR in dB over all channels; inf for identical images.
+
+    original and test are file names or arrays from load_image.
+    """
+    x, y = _pair(original, test)
+    rows = rows or tile_rows
+    squared_error = 0.0
+    for start in range(0, x.shape[0], rows):
+        diff = x[start:start + rows].astype(np.float32) - y[start:start + rows].astype(np.float32)
+        squared_error += float(np.square(diff).sum(dtype=np.float64))
+    mse = squared_error / x.size
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(255 * 255 / mse)
+
+
+def ssim(original, test, rows = None):
+    x, y = _pair(original, test)
+    return _ssim_cs(x, y, rows or tile_rows)[0]
+
+
+def ms_ssim(original, test, rows = None):
+    x, y = _pair(original, test)
+    rows = rows or tile_rows
+    result = 1.0
+    for scale, weight in enumerate(ms_ssim_weights):
+        ssim_value, cs_value = _ssim_cs(x, y, rows)
+        if scale == len(ms_ssim_weights) - 1:
+            result *= max(ssim_value, 0.0) ** weight
+        else:
+            result *= max(cs_value, 0.0) ** weight
+            x = _downsample(x, rows)
+            y = _downsample(y, rows)
+    return result
+
+
+def compare(original_file_name, test_file_name, names = ("psnr", "ssim"), rows = None):
+    """
+    Decode both images once and compute the requested metrics.
+
+    :return: dict(name: value)
+    """
+    functions = {"psnr": psnr, "ssim": ssim, "ms_ssim": ms_ssim}
+    x, y = _pair(original_file_name, test_file_name)
+    return {name: functions[name](x, y, rows) for name in names}
@@ -0,0 +1,119 @@
+import os
+import json
+import math
+import time
+import sqlite3
+
+from PIL import Image
+from tool_runner import get_tool_runner
+
+reference_bpp = {"image": 0.6, "video": 0.06} # bits per pixel of our encodes (per frame for video)
+efficient_codecs = ["hevc", "av1", "vp9", "vvc", "heif", "avif", "webp"]
+min_results = 5 # past results of a codec and bits per pixel bucket before they replace the estimate
+probe_fields = ["kind", "codec", "width", "height", "bpp"]
+
+
+class Prober:
+    """
+    Cheap look at a source before encoding: codec, dimensions and bits per pixel from the
+    Pillow header or ffprobe, cached by path, mtime and size.
+
+    expected_ratio() predicts source size / encoded size from the ratios of past encodes
+    with the same codec and bits per pixel (half octave buckets), or from the bits per
+    pixel of our encodes while there are not enough of them.
+    """
+    ffprobe_path = "ffprobe"
+
+    def __init__(self, db_path = None, ffprobe_path = None) -> None:
+        self.db_path = db_path or ":memory:"
+        if ffprobe_path:
+            self.ffprobe_path = ffprobe_path
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS probes (
+                path TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+                kind TEXT, codec TEXT, width INTEGER, height INTEGER, bpp REAL)""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS probe_results (
+                kind TEXT, codec TEXT, bucket INTEGER, ratio REAL, log_ratio REAL, created REAL)""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS probe_results_key ON probe_results (kind, codec, bucket)")
+            self.pid = os.getpid()
+        return self.connection
+
+    def probe(self, path):
+        """
+        :return: dict(kind, codec, width, height, bpp); codec is None if probing failed
+        """
+        path = os.path.normpath(path)
+        stat = os.stat(path)
+        connection = self.connect()
+        row = connection.execute(f"SELECT {', '.join(probe_fields)} FROM probes WHERE path = ? AND mtime = ? AND size = ?",
+                                 (path, stat.st_mtime, stat.st_size)).fetchone()
+        if row is not None:
+            return dict(zip(probe_fields, row))
+
+        try:
+            if os.path.splitext(path)[1].lower() in [".jpg", ".jpeg", ".png", ".webp", ".heic", ".avif"]:
+                result = self.probe_image(path, stat.st_size)
+            else:
+                result = self.probe_video(path, stat.st_size)
+        except Exception as e:
+            print("WARNING: probe -", e, path)
+            return {"kind": None, "codec": None, "width": None, "height": None, "bpp": None}
+
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (path, stat.st_mtime, stat.st_size) + tuple(result[field] for field in probe_fields))
+        return result
+
+    def probe_image(self, path, size):
+        # Image.open reads the header only
+        with Image.open(path) as image:
+            width, height = image.size
+            codec = image.format.lower()
+        return {"kind": "image", "codec": codec, "width": width, "height": height, "bpp": size * 8 / (width * height)}
+
+    def probe_video(self, path, size):
+        res = get_tool_runner().run_sync("ffprobe", [self.ffprobe_path, "-v", "error", "-select_streams", "v:0",
+                                                     "-show_entries", "stream=codec_name,width,height,avg_frame_rate,bit_rate:format=duration",
+                                                     "-of", "json", path]).stdout
+        info = json.loads(res)
+        stream = info["streams"][0]
+        numerator, denominator = stream.get("avg_frame_rate", "0/0").split("/")
+        fps = float(numerator) / float(denominator) if float(denominator) else 0
+        bit_rate = float(stream.get("bit_rate") or 0)
+        if not bit_rate:
+            duration = float(info.get("format", {}).get("duration") or 0)
+            bit_rate = size * 8 / duration if duration else 0
+        width, height = int(stream["width"]), int(stream["height"])
+        bpp = bit_rate / (width * height * fps) if bit_rate and fps else None
+        return {"kind": "video", "codec": stream["codec_name"], "width": width, "height": height, "bpp": bpp}
+
+    def bucket(self, bpp):
+        return round(math.log2(bpp) * 2)
+
+    def expected_ratio(self, probe):
+        """
+        :return: (expected ratio or None if unknown, reason)
+        """
+        if probe["codec"] is None or not probe["bpp"]:
+            return None, "not probed"
+        row = self.connect().execute(
+            "SELECT COUNT(*), AVG(log_ratio) FROM probe_results WHERE kind = ? AND codec = ? AND bucket = ?",
+            (probe["kind"], probe["codec"], self.bucket(probe["bpp"]))).fetchone()
+        if row[0] >= min_results:
+            return math.exp(row[1]), f"{row[0]} past {probe['codec']} encodes at {probe['bpp']:.3f} bpp"
+        if probe["codec"] in efficient_codecs:
+            return 1.0, f"already {probe['codec']}"
+        return probe["bpp"] / reference_bpp[probe["kind"]], f"{probe['codec']} {probe['bpp']:.3f} bpp"
+
+    def add_result(self, probe, ratio):
+        if probe["codec"] is None or not probe["bpp"] or not ratio:
+            return
+        with self.connect() as connection:
+            connection.execute("INSERT INTO probe_results VALUES (?, ?, ?, ?, ?, ?)",
+                               (probe["kind"], probe["codec"], self.bucket(probe["bpp"]), ratio, math.log(ratio), time.time()))
@@ -0,0 +1,169 @@
+import os
+import math
+import time
+
+
+def cgroup_cpus():
+    """
+    CPU limit of the cgroup (v2 cpu.max or v1 cfs quota) or None without a limit.
+    """
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as quota_file, open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as period_file:
+            quota, period = int(quota_file.read()), int(period_file.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cpus():
+    """
+    Cores this process may use: affinity mask, then the cgroup quota.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpus()
+    if limit is not None:
+        cpus = min(cpus, max(math.ceil(limit), 1))
+    return max(cpus, 1)
+
+
+def cpu_busy():
+    """
+    :return: (busy, total) jiffies of all cores from /proc/stat, None where it does not exist
+    """
+    try:
+        with open("/proc/stat") as stat:
+            values = [int(value) for value in stat.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    idle = values[3] + (values[4] if len(values) > 4 else 0)
+    return sum(values) - idle, sum(values)
+
+
+def rotational(path):
+    """
+    :return: True for a spinning disk, False for SSD/NVMe, None if unknown (network
+        filesystems, Windows)
+    """
+    try:
+        device = os.stat(path).st_dev
+        block = "/sys/dev/block/%i:%i" % (os.major(device), os.minor(device))
+        # a partition has its queue in the parent device
+        for queue in (os.path.join(block, "queue"), os.path.join(block, "..", "queue")):
+            if os.path.exists(os.path.join(queue, "rotational")):
+                with open(os.path.join(queue, "rotational")) as rotational_file:
+                    return rotational_file.read().strip() == "1"
+    except (OSError, AttributeError, ValueError):
+        pass
+    return None
+
+
+def storage_threads(*paths):
+    """
+    Concurrent file copies for the slowest of the paths: a spinning disk seeks between
+    parallel streams, an SSD needs a deep queue, a network share hides its latency with
+    many requests in flight.
+    """
+    threads = []
+    for path in paths:
+        kind = rotational(path)
+        if kind:
+            threads.append(2)
+        elif kind is None:
+            threads.append(16)
+        else:
+            threads.append(min(max(available_cpus() * 2, 4), 32))
+    return min(threads) if threads else 4
+
+
+class ResourceBudget:
+    """
+    One thread budget for the lanes of the scheduler and the thread flags of the tools.
+
+    plan() splits the cores: an encode gets a few threads (avifenc -j, ffmpeg -threads,
+    7z -mmt, stream archiver) and the lanes get as many workers as fit. While a run goes
+    on, adjust() moves the cores of an idle video lane to the image lane, and adds or
+    removes an image worker when the measured CPU utilization is low or saturated.
+    """
+    low_utilization = 0.70
+    high_utilization = 0.95
+    interval = 5.0 # seconds between utilization samples
+
+    def __init__(self, cpus = None) -> None:
+        self.cpus = cpus or available_cpus()
+        self.last_sample = cpu_busy()
+        self.last_time = time.time()
+        self.extra_image = 0
+        self.threads, self.lanes = self.plan()
+
+    def plan(self):
+        """
+        :return: dict(tool: threads), dict(lane: workers)
+        """
+        cpus = self.cpus
+        threads = {
+            "image": min(max(cpus // 8, 1), 4),
+            "video": min(max(cpus // 4, 1), 8),
+            "archive": min(max(cpus // 8, 1), 4),
+        }
+        # a segmented CPU encode uses about half of the machine
+        threads["video_segments"] = max(cpus // 2 // threads["video"], 1)
+        lanes = {
+            "video": 1,
+            "image": max(cpus // threads["image"] // 2, 1),
+            "archive": max(cpus // threads["archive"] // 4, 1),
+            "hash": min(max(cpus // 2, 2), 8), # mostly waiting for the disk
+        }
+        return threads, lanes
+
+    def max_workers(self):
+        """
+        Processes of the pool: the planned lanes plus the image workers that may take
+        the place of the video lane.
+        """
+        return sum(self.lanes.values()) + self.borrowed_image()
+
+    def borrowed_image(self):
+        return max(self.threads["video"] * self.threads["video_segments"] // self.threads["image"], 1)
+
+    def utilization(self):
+        """
+        :return: CPU utilization since the last call or None (not measured yet or no /proc/stat)
+        """
+        sample = cpu_busy()
+        previous, self.last_sample = self.last_sample, sample
+        self.last_time = time.time()
+        if sample is None or previous is None or sample[1] == previous[1]:
+            return None
+        return (sample[0] - previous[0]) / (sample[1] - previous[1])
+
+    def adjust(self, scheduler):
+        """
+        Set the image lane limit of a running LaneScheduler.
+        """
+        if time.time() - self.last_time < self.interval:
+            return
+        utilization = self.utilization()
+        video_idle = not scheduler.pending["video"] and not scheduler.running["video"]
+        if utilization is not None and scheduler.pending["image"]:
+            if utilization < self.low_utilization:
+                self.extra_image = min(self.extra_image + 1, self.borrowed_image())
+            elif utilization > self.high_utilization and self.extra_image > 0:
+                self.extra_image -= 1
+        limit = self.lanes["image"] + self.extra_image
+        if video_idle:
+            limit += self.borrowed_image()
+        others = sum(scheduler.limits[lane] for lane in scheduler.limits if lane != "image")
+        scheduler.set_limit("image", max(min(limit, scheduler.max_workers - others), 1))
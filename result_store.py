@@ -0,0 +1,130 @@
+import os
+import ast
+import time
+import sqlite3
+import hashlib
+
+store_path = "cache.db"
+
+_hash_cache = {}
+
+
+def content_hash(file_path):
+    """
+    SHA-256 of the file content, remembered per path, mtime and size.
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_mtime, stat.st_size)
+    if key not in _hash_cache:
+        hash_function = hashlib.sha256()
+        with open(file_path, "rb") as a_file:
+            for buf in iter(lambda: a_file.read(1024 * 1024), b""):
+                hash_function.update(buf)
+        _hash_cache[key] = hash_function.hexdigest()
+    return _hash_cache[key]
+
+
+class EncodeResultStore:
+    """
+    Encode results (output size, encode time, PSNR) in a SQLite database.
+
+    A result is keyed by the source content hash, the encoder settings name
+    (method, format, codec, speed, threads) and the quality value, so moved or renamed
+    files still hit. Every result is committed on its own and the database runs in WAL
+    mode, so several optimizer processes can write at the same time.
+    """
+
+    def __init__(self, db_path = None) -> None:
+        self.db_path = db_path or store_path
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS results (
+                source_hash TEXT, encoder TEXT, quality REAL,
+                size INTEGER, encode_time REAL, psnr REAL, created REAL, used REAL, source_size INTEGER,
+                PRIMARY KEY (source_hash, encoder, quality))""")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(results)")]
+            if "source_size" not in columns:
+                # a store of an older version
+                try:
+                    self.connection.execute("ALTER TABLE results ADD COLUMN source_size INTEGER")
+                except sqlite3.OperationalError as e:
+                    # another process added it since PRAGMA table_info
+                    if "duplicate column" not in str(e):
+                        raise
+            self.pid = os.getpid()
+        return self.connection
+
+    def get(self, source_hash, encoder, quality):
+        connection = self.connect()
+        row = connection.execute(
+            "SELECT size, encode_time, psnr FROM results WHERE source_hash = ? AND encoder = ? AND quality = ?",
+            (source_hash, encoder, quality)).fetchone()
+        if row is None:
+            return None
+        with connection:
+            connection.execute("UPDATE results SET used = ? WHERE source_hash = ? AND encoder = ? AND quality = ?",
+                               (time.time(), source_hash, encoder, quality))
+        return {"size": row[0], "encode_time": row[1], "psnr": row[2]}
+
+    def put(self, source_hash, encoder, quality, size, encode_time = None, psnr = None, source_size = None):
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute(
+                """INSERT INTO results (source_hash, encoder, quality, size, encode_time, psnr, created, used, source_size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (source_hash, encoder, quality) DO UPDATE SET
+                size = excluded.size, encode_time = COALESCE(excluded.encode_time, encode_time),
+                psnr = COALESCE(excluded.psnr, psnr), used = excluded.used,
+                source_size = COALESCE(excluded.source_size, source_size)""",
+                (source_hash, encoder, quality, size, encode_time, psnr, now, now, source_size))
+
+    def throughput(self, encoder):
+        """
+        :return: (number of timed encodes, source MB/s) of the encoder settings or (0, None)
+        """
+        count, source_size, encode_time = self.connect().execute(
+            """SELECT COUNT(*), SUM(source_size), SUM(encode_time) FROM results
+            WHERE encoder = ? AND source_size IS NOT NULL AND encode_time > 0""", (encoder, )).fetchone()
+        if not count:
+            return 0, None
+        return count, source_size / encode_time / (1024 * 1024)
+
+    def evict(self, max_entries = None, max_age_days = None):
+        """
+        Remove results unused for max_age_days and then the least recently used
+        ones above max_entries.
+
+        :return: number of removed results
+        """
+        removed = 0
+        with self.connect() as connection:
+            if max_age_days is not None:
+                removed += connection.execute("DELETE FROM results WHERE used < ?",
+                                              (time.time() - max_age_days * 24 * 3600, )).rowcount
+            if max_entries is not None:
+                removed += connection.execute(
+                    "DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                    (max_entries, )).rowcount
+        return removed
+
+    def import_legacy(self, legacy_path = "cache.dat"):
+        """
+        Move results of the old eval()'d cache.dat, keyed by file name, into the store.
+        """
+        if not os.path.exists(legacy_path):
+            return 0
+        with open(legacy_path) as f:
+            cache = ast.literal_eval(f.readline() or "{}")
+
+        imported = 0
+        for (encoder, file_name, quality), size in cache.items():
+            if os.path.exists(file_name):
+                self.put(content_hash(file_name), encoder, quality, size)
+                imported += 1
+        os.replace(legacy_path, legacy_path + ".imported")
+        return imported
@@ -0,0 +1,158 @@
+import os
+import json
+import math
+import time
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None # Windows: CPU time of the worker process only, without encoders
+
+
+def cpu_time():
+    """
+    CPU seconds of this process and of the finished tools it started (avifenc, ffmpeg, 7z).
+    """
+    seconds = time.process_time()
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        seconds += usage.ru_utime + usage.ru_stime
+    return seconds
+
+
+class StageTimer:
+    """
+    Wall time, CPU time and bytes per processing stage of one file or pack.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.stages = {}
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name, size = 0):
+        start = time.perf_counter()
+        start_cpu = cpu_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {"time": 0.0, "cpu": 0.0, "bytes": 0})
+            stage["time"] += time.perf_counter() - start
+            stage["cpu"] += cpu_time() - start_cpu
+            stage["bytes"] += size
+
+    def result(self):
+        return {"path": self.path, "pid": os.getpid(), "total": time.perf_counter() - self.start, "stages": self.stages}
+
+
+def percentile(values, fraction):
+    # nearest rank on sorted values
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+class RunMetrics:
+    """
+    Collect StageTimer results of a run: every result is appended to a JSONL file as it
+    arrives, the summary has per stage percentiles, CPU time and throughput, and can be
+    written as a Prometheus textfile (node_exporter textfile collector).
+    """
+    quantiles = [0.5, 0.9, 0.99]
+
+    def __init__(self, jsonl_path = None, prometheus_path = None) -> None:
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.start = time.time()
+        self.stages = {}
+        self.files = 0
+        self.jsonl = open(jsonl_path, "a", encoding="utf-8") if jsonl_path else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.jsonl is not None:
+            self.jsonl.close()
+            self.jsonl = None
+
+    def add(self, lane, timings):
+        if timings is None:
+            return
+        self.files += 1
+        for name, stage in timings["stages"].items():
+            values = self.stages.setdefault(name, {"times": [], "cpu": 0.0, "bytes": 0})
+            values["times"].append(stage["time"])
+            values["cpu"] += stage["cpu"]
+            values["bytes"] += stage["bytes"]
+        if self.jsonl is not None:
+            self.jsonl.write(json.dumps(dict(timings, lane=lane, finished=time.time())) + "\n")
+            self.jsonl.flush()
+
+    def summary(self):
+        """
+        :return: dict(stage: count, time, cpu, bytes, p50/p90/p99, MB/s and files/s of the
+            stage's own time and of the run's wall time)
+        """
+        run_time = max(time.time() - self.start, 1e-9)
+        result = {}
+        for name, values in self.stages.items():
+            times = sorted(values["times"])
+            busy = max(sum(times), 1e-9)
+            result[name] = {
+                "count": len(times),
+                "time": sum(times),
+                "cpu": values["cpu"],
+                "bytes": values["bytes"],
+                "mb_per_s": values["bytes"] / busy / (1024 * 1024),
+                "files_per_s": len(times) / busy,
+                "run_mb_per_s": values["bytes"] / run_time / (1024 * 1024),
+                "run_files_per_s": len(times) / run_time,
+            }
+            for quantile in self.quantiles:
+                result[name][f"p{int(quantile * 100)}"] = percentile(times, quantile)
+        return result
+
+    def print_summary(self):
+        print("Stages:")
+        for name, stage in sorted(self.summary().items(), key=lambda item: -item[1]["time"]):
+            print("\t%-8s %6i files, %8.2fs (cpu %8.2fs), p50 %.3fs p90 %.3fs p99 %.3fs, %.2f MB/s, %.2f files/s" % (
+                name, stage["count"], stage["time"], stage["cpu"], stage["p50"], stage["p90"], stage["p99"],
+                stage["run_mb_per_s"], stage["run_files_per_s"]))
+
+    def write_prometheus(self, path = None):
+        path = path or self.prometheus_path
+        if not path:
+            return
+        summary = self.summary()
+        lines = [
+            "# HELP transcoder_stage_seconds Time of one file in a backup stage.",
+            "# TYPE transcoder_stage_seconds summary",
+        ]
+        for name, stage in summary.items():
+            for quantile in self.quantiles:
+                lines.append(f'transcoder_stage_seconds{{stage="{name}",quantile="{quantile}"}} {stage[f"p{int(quantile * 100)}"]}')
+            lines.append(f'transcoder_stage_seconds_sum{{stage="{name}"}} {stage["time"]}')
+            lines.append(f'transcoder_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+        for metric, key, description in [("cpu_seconds", "cpu", "CPU time"), ("bytes", "bytes", "Bytes read")]:
+            lines.append(f"# HELP transcoder_stage_{metric}_total {description} of a backup stage in the last run.")
+            lines.append(f"# TYPE transcoder_stage_{metric}_total counter")
+            lines += [f'transcoder_stage_{metric}_total{{stage="{name}"}} {stage[key]}' for name, stage in summary.items()]
+        lines += [
+            "# HELP transcoder_run_seconds Wall time of the last backup run.",
+            "# TYPE transcoder_run_seconds gauge",
+            f"transcoder_run_seconds {time.time() - self.start}",
+            "# HELP transcoder_run_files Files processed in the last backup run.",
+            "# TYPE transcoder_run_files gauge",
+            f"transcoder_run_files {self.files}",
+            "# HELP transcoder_run_finished_timestamp_seconds End of the last backup run.",
+            "# TYPE transcoder_run_finished_timestamp_seconds gauge",
+            f"transcoder_run_finished_timestamp_seconds {time.time()}",
+        ]
+        # the collector must never read a half written file
+        with open(path + ".tmp", "w", encoding="utf-8") as prometheus_file:
+            prometheus_file.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,107 @@
+import queue
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+class LaneScheduler:
+    """
+    Process pool with a separate concurrency limit and a bounded queue per lane.
+
+    The pool has as many processes as all lanes together, so a lane never waits for
+    another one: a long video encode occupies only a "video" slot. Finished tasks are
+    reported through a completion queue and passed to on_done(lane, result) in the
+    calling thread, nothing is polled; a failed task goes to on_error(lane, function,
+    args, exception) if it is set.
+
+    With a budget (ResourceBudget) the lane limits may change during the run; the pool
+    then has max_workers processes, so a lane can grow while another one is idle.
+    """
+
+    def __init__(self, lanes, on_done, queue_size = 256, initializer = None, initargs = (), max_workers = None, budget = None,
+                 on_error = None) -> None:
+        self.limits = dict(lanes)
+        self.on_done = on_done
+        self.on_error = on_error
+        self.queue_size = queue_size
+        self.budget = budget
+        self.pending = {lane: deque() for lane in self.limits}
+        self.running = {lane: 0 for lane in self.limits}
+        self.completed = queue.Queue()
+        self.handling = False
+        self.max_workers = max(max_workers or 0, sum(self.limits.values()))
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                            initializer=initializer, initargs=initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.executor.shutdown(wait=exc_type is None, cancel_futures=exc_type is not None)
+
+    def submit(self, lane, function, *args):
+        """
+        Queue function(*args) in lane; blocks while the lane queue is full.
+        """
+        self.pending[lane].append((function, args))
+        self.drain()
+        self.dispatch()
+        while len(self.pending[lane]) > self.queue_size:
+            self.wait_one()
+
+    def set_limit(self, lane, limit):
+        if limit != self.limits[lane]:
+            print("Lane %s: %i -> %i workers" % (lane, self.limits[lane], limit))
+            self.limits[lane] = limit
+
+    def dispatch(self):
+        for lane, tasks in self.pending.items():
+            while tasks and self.running[lane] < self.limits[lane]:
+                function, args = tasks.popleft()
+                future = self.executor.submit(function, *args)
+                self.running[lane] += 1
+                future.add_done_callback(lambda f, lane=lane, task=(function, args): self.completed.put((lane, f, task)))
+
+    def drain(self):
+        """
+        Handle the tasks finished so far without waiting for more; nothing to do when
+        called from on_done or on_error, the outer call picks them up.
+        """
+        while not self.handling:
+            try:
+                completion = self.completed.get_nowait()
+            except queue.Empty:
+                return
+            self.handle(*completion)
+
+    def wait_one(self):
+        """
+        Wait for the next finished task; only for backpressure and join().
+        """
+        self.handle(*self.completed.get())
+
+    def handle(self, lane, future, task):
+        function, args = task
+        self.running[lane] -= 1
+        if self.budget is not None:
+            self.budget.adjust(self)
+        self.dispatch()
+        handling, self.handling = self.handling, True
+        try:
+            result = future.result()
+        except Exception as e:
+            print("ERROR (%s worker):" % lane, e)
+            if self.on_error is not None:
+                self.on_error(lane, function, args, e)
+            return
+        else:
+            self.on_done(lane, result)
+        finally:
+            self.handling = handling
+
+    def busy(self):
+        return any(self.pending.values()) or any(self.running.values())
+
+    def join(self):
+        while self.busy():
+            self.wait_one()
@@ -0,0 +1,180 @@
+import os
+import time
+import shutil
+import getpass
+import sqlite3
+import tempfile
+import contextlib
+
+from stat import S_ISDIR
+
+ram_paths = [r"a:\tmp", "/dev/shm"] # RAM disk on Windows, tmpfs on Linux; the first existing one is used
+reservations_name = "transcoder-reservations.db"
+directory_prefix = "transcoder-"
+
+
+def private_directory(ram_path):
+    """
+    Directory of this user in the RAM path for the reservations and the temporary
+    directories, mode 0700; None if it exists but is not ours (another owner, a
+    symlink, open permissions).
+    """
+    user = os.getuid() if hasattr(os, "getuid") else getpass.getuser()
+    path = os.path.join(ram_path, f"{directory_prefix}{user}")
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    stat = os.lstat(path)
+    if not S_ISDIR(stat.st_mode) or (hasattr(os, "getuid") and (stat.st_uid != os.getuid() or stat.st_mode & 0o077)):
+        print("WARNING: TempStorage - not a private directory, intermediates go to disk -", path)
+        return None
+    return path
+
+
+def process_alive(pid):
+    if os.name == "nt":
+        # os.kill() would terminate the process on Windows
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        queried = kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        return not queried or exit_code.value == 259 # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class TempStorage:
+    """
+    Temporary directories in RAM up to a memory budget, on disk above it.
+
+    directory(size) reserves the expected size of the intermediates; reservations of
+    all worker processes are kept in a small SQLite database in a private directory of
+    the user in the RAM path, so
+    parallel workers together stay below budget_mb. A reservation ends with its
+    directory; reservations of crashed workers (the process is gone) are dropped and
+    their directories removed.
+    """
+
+    budget_mb = 2048 # RAM for intermediates of all workers together
+    spill_path = None # disk directory above the budget, None - the system temp directory
+
+    def __init__(self, ram_path = None, budget_mb = None, spill_path = None) -> None:
+        self.ram_path = ram_path or next((path for path in ram_paths if os.path.isdir(path)), None)
+        self.private_path = None
+        if self.ram_path is not None:
+            try:
+                self.private_path = private_directory(self.ram_path)
+            except OSError as e:
+                print("WARNING: TempStorage -", e)
+        if budget_mb is not None:
+            self.budget_mb = budget_mb
+        if spill_path:
+            self.spill_path = spill_path
+        self.budget = self.budget_mb * 1024 * 1024
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(os.path.join(self.private_path, reservations_name), timeout=60,
+                                              isolation_level=None)
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS reservations (
+                path TEXT PRIMARY KEY, size INTEGER, pid INTEGER, created REAL)""")
+            self.pid = os.getpid()
+        return self.connection
+
+    def usage(self):
+        """
+        :return: bytes reserved in RAM by all processes
+        """
+        if self.private_path is None:
+            return 0
+        return self.connect().execute("SELECT COALESCE(SUM(size), 0) FROM reservations").fetchone()[0]
+
+    def reserve(self, size, prefix):
+        """
+        :return: new directory in RAM if size fits in the budget, None otherwise
+        """
+        if self.private_path is None or size > self.budget:
+            return None
+        try:
+            connection = self.connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for path, pid in connection.execute("SELECT path, pid FROM reservations").fetchall():
+                    if not os.path.exists(path) or not process_alive(pid):
+                        if self.owned(path):
+                            shutil.rmtree(path, ignore_errors=True)
+                        connection.execute("DELETE FROM reservations WHERE path = ?", (path, ))
+                reserved = connection.execute("SELECT COALESCE(SUM(size), 0) FROM reservations").fetchone()[0]
+                if reserved + size > self.budget or shutil.disk_usage(self.ram_path).free < size:
+                    connection.execute("COMMIT")
+                    return None
+                path = tempfile.mkdtemp(prefix=prefix, dir=self.private_path)
+                connection.execute("INSERT INTO reservations VALUES (?, ?, ?, ?)", (path, size, os.getpid(), time.time()))
+                connection.execute("COMMIT")
+                return path
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        except (OSError, sqlite3.Error) as e:
+            print("WARNING: TempStorage -", e)
+            return None
+
+    def owned(self, path):
+        """
+        :return: True for a temporary directory of this storage, the only paths it removes
+        """
+        real_path = os.path.realpath(path)
+        return (os.path.dirname(real_path) == os.path.realpath(self.private_path)
+                and os.path.basename(real_path).startswith(directory_prefix))
+
+    def release(self, path):
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            self.connect().execute("DELETE FROM reservations WHERE path = ?", (path, ))
+        except sqlite3.Error as e:
+            print("WARNING: TempStorage -", e)
+
+    @contextlib.contextmanager
+    def directory(self, size = 0, prefix = directory_prefix):
+        """
+        Temporary directory for intermediates of about size bytes, removed on exit;
+        nothing is reserved for size 0.
+        """
+        path = self.reserve(size, prefix) if size > 0 else None
+        if path is None:
+            with tempfile.TemporaryDirectory(prefix=prefix, dir=self.spill_path) as path:
+                yield path
+            return
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+
+_storage = None
+
+
+def get_temp_storage():
+    global _storage
+    if _storage is None:
+        _storage = TempStorage()
+    return _storage
+
+
+def temp_directory(size = 0):
+    """
+    get_temp_storage().directory(size): RAM if the reservation fits, disk otherwise.
+    """
+    return get_temp_storage().directory(size)
@@ -0,0 +1,92 @@
+import os
+import json
+import tempfile
+import unittest
+
+import archiver
+from archiver import StreamArchiver, VolumeWriter
+
+
+class StreamArchiverTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.directory = self.temp.name
+        self.addCleanup(self.temp.cleanup)
+
+    def write(self, name, data):
+        file_path = os.path.join(self.directory, "source", name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as a_file:
+            a_file.write(data)
+        return file_path, name
+
+    def read(self, file_path):
+        with open(file_path, "rb") as a_file:
+            return a_file.read()
+
+    def round_trip(self, stream_archiver, members, password = None):
+        volumes, size, archive_hash, member_hashes = stream_archiver.archive(
+            os.path.join(self.directory, "archive", "test"), members, 3, password, "sha256")
+        self.assertEqual(size, sum(os.path.getsize(volume) for volume in volumes))
+        self.assertEqual(archive_hash, archiver.hash_volumes(volumes, "sha256"))
+        self.assertEqual(len(member_hashes), len(members))
+        output_directory = os.path.join(self.directory, "output")
+        extracted = stream_archiver.extract(volumes, output_directory, password)
+        self.assertEqual(sorted(extracted), sorted(os.path.join(output_directory, name) for _, name in members))
+        for file_path, name in members:
+            self.assertEqual(self.read(os.path.join(output_directory, name)), self.read(file_path))
+        return volumes
+
+    def test_multi_volume_with_empty_member(self):
+        stream_archiver = StreamArchiver(threads=2, volume_size_mb=1, compression="lzma")
+        stream_archiver.chunk_size = 256 * 1024
+        members = [self.write("first.bin", os.urandom(1500 * 1000)),
+                   self.write("empty.txt", b""),
+                   self.write(os.path.join("sub", "last.txt"), b"last" * 1000),
+                   self.write("empty_last.txt", b"")]
+        volumes = self.round_trip(stream_archiver, members)
+        self.assertGreater(len(volumes), 1)
+
+    @unittest.skipIf(archiver.AESGCM is None, "needs cryptography")
+    def test_encrypted(self):
+        stream_archiver = StreamArchiver(threads=2, volume_size_mb=1)
+        members = [self.write("secret.txt", b"secret" * 100000), self.write("empty.txt", b"")]
+        volumes = self.round_trip(stream_archiver, members, "password")
+        self.assertNotIn(b"secret", b"".join(self.read(volume) for volume in volumes))
+        with self.assertRaises(ValueError):
+            stream_archiver.extract(volumes, os.path.join(self.directory, "nopassword"))
+        with self.assertRaises(Exception):
+            stream_archiver.extract(volumes, os.path.join(self.directory, "wrong"), "wrong password")
+
+    def test_unsafe_member_name(self):
+        # a crafted archive: the member name leads out of the output directory
+        archive_path = os.path.join(self.directory, "crafted.tca")
+        stream_archiver = StreamArchiver(compression="lzma")
+        compress = stream_archiver._compressor("lzma", 1)
+        header = json.dumps({"format": 1, "compression": "lzma", "level": 1, "chunk_size": 1024}).encode("utf-8")
+        writer = VolumeWriter(archive_path, 1000 * 1000, archiver.change_detection.new_hash("sha256"))
+        writer.write(StreamArchiver.magic)
+        stream_archiver._write_frame(writer, b"H", header)
+        for name in ("../../escaped.txt", os.path.abspath(os.path.join(self.directory, "absolute.txt"))):
+            stream_archiver._write_frame(writer, b"M", json.dumps({"name": name, "size": 1, "mtime": 0}).encode("utf-8"))
+        stream_archiver._write_frame(writer, b"C", compress(b"xy"))
+        stream_archiver._write_frame(writer, b"Z", b"2")
+        volumes = writer.close()
+        output_directory = os.path.join(self.directory, "output", "nested")
+        with self.assertRaises(ValueError):
+            stream_archiver.extract(volumes, output_directory)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "escaped.txt")))
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "absolute.txt")))
+
+    def test_failed_archive_leaves_no_volumes(self):
+        stream_archiver = StreamArchiver(volume_size_mb=1, compression="lzma")
+        members = [self.write("first.bin", os.urandom(1500 * 1000)),
+                   (os.path.join(self.directory, "missing.bin"), "missing.bin")]
+        archive_path = os.path.join(self.directory, "archive", "failed")
+        with self.assertRaises(FileNotFoundError):
+            stream_archiver.archive(archive_path, members, 1)
+        self.assertEqual(os.listdir(os.path.dirname(archive_path)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
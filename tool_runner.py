@@ -0,0 +1,131 @@
+import asyncio
+import weakref
+import functools
+import subprocess
+
+from resource_budget import available_cpus
+
+tool_limits = {} # concurrent processes per tool in one event loop, e.g. {"ffmpeg": 2}; not set - available_cpus()
+chunk_size = 1024 * 1024
+
+
+class ToolRunner:
+    """
+    Run external tools (avifenc, heif-enc, magick, ffmpeg, 7z) as asyncio subprocesses.
+
+    Commands are argument lists, never shell strings, so quotes and spaces in paths are
+    safe. Every tool has a semaphore per event loop, so one coordinator can keep many
+    jobs in flight without starting more processes of a tool than its limit. stdout and
+    stderr are read while the tool runs and may be passed to a callback; stdin is fed
+    from bytes or streamed from a file. A timeout or a cancelled task kills the process.
+    Errors are raised as subprocess.CalledProcessError and subprocess.TimeoutExpired.
+    """
+    timeout = None
+
+    def __init__(self, limits = None, timeout = None) -> None:
+        self.limits = dict(tool_limits)
+        self.limits.update(limits or {})
+        if timeout is not None:
+            self.timeout = timeout
+        self.semaphores = weakref.WeakKeyDictionary()
+
+    def semaphore(self, tool):
+        semaphores = self.semaphores.setdefault(asyncio.get_running_loop(), {})
+        if tool not in semaphores:
+            semaphores[tool] = asyncio.Semaphore(self.limits.get(tool) or available_cpus())
+        return semaphores[tool]
+
+    async def _feed(self, process, input, input_file, on_input):
+        try:
+            if input is not None:
+                process.stdin.write(input)
+                await process.stdin.drain()
+            elif input_file is not None:
+                with open(input_file, "rb") as a_file:
+                    for buf in iter(lambda: a_file.read(chunk_size), b""):
+                        if on_input is not None:
+                            on_input(buf)
+                        process.stdin.write(buf)
+                        await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the tool failed, its exit code tells why
+        finally:
+            process.stdin.close()
+
+    async def _read(self, stream, name, on_output):
+        data = bytearray()
+        while True:
+            buf = await stream.read(65536)
+            if not buf:
+                return bytes(data)
+            data += buf
+            if on_output is not None:
+                on_output(name, buf.decode("utf-8", errors="replace"))
+
+    async def run(self, tool, args, input = None, input_file = None, on_input = None, on_output = None,
+                  timeout = None, check = True, cwd = None):
+        """
+        :param tool: semaphore name, e.g. "avifenc"
+        :param args: command as a list, the executable first
+        :param input: bytes for stdin; input_file - file streamed to stdin, on_input(chunk) sees every chunk
+        :param on_output: on_output("stdout" or "stderr", text) while the tool runs
+        :return: subprocess.CompletedProcess with bytes stdout and stderr
+        """
+        args = [str(arg) for arg in args]
+        feed = input is not None or input_file is not None
+        async with self.semaphore(tool):
+            process = await asyncio.create_subprocess_exec(
+                *args, cwd=cwd, stdin=subprocess.PIPE if feed else subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            tasks = [asyncio.ensure_future(self._read(process.stdout, "stdout", on_output)),
+                     asyncio.ensure_future(self._read(process.stderr, "stderr", on_output))]
+            if feed:
+                tasks.append(asyncio.ensure_future(self._feed(process, input, input_file, on_input)))
+            try:
+                done, pending = await asyncio.wait(tasks, timeout=timeout or self.timeout)
+                if pending:
+                    raise subprocess.TimeoutExpired(args, timeout or self.timeout)
+                stdout, stderr = tasks[0].result(), tasks[1].result()
+                await process.wait()
+            finally:
+                # timeout, cancellation or a failed feed: do not leave the tool running
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, args, stdout, stderr)
+        return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+    def run_sync(self, tool, args, **kwargs):
+        """
+        run() for callers without an event loop (worker processes, CLI).
+        """
+        return asyncio.run(self.run(tool, args, **kwargs))
+
+
+_runner = None
+
+
+def get_tool_runner():
+    global _runner
+    if _runner is None:
+        _runner = ToolRunner()
+    return _runner
+
+
+def synchronous(coroutine_function):
+    """
+    Blocking twin of an async converter method: convert_to_x = synchronous(convert_to_x_async).
+
+    The twin is named without the _async suffix, so bound methods pickle (process pools)
+    as the blocking method and not as the coroutine one.
+    """
+    @functools.wraps(coroutine_function)
+    def wrapper(*args, **kwargs):
+        return asyncio.run(coroutine_function(*args, **kwargs))
+    wrapper.__name__ = coroutine_function.__name__[:-len("_async")]
+    wrapper.__qualname__ = coroutine_function.__qualname__[:-len("_async")]
+    return wrapper
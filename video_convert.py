@@ -1,22 +1,35 @@
 import os
-import tempfile
+import re
+import sys
+import glob
+import time
+import asyncio
 import argparse
-import subprocess
 
 from pathlib import Path
-from img_convert import BaseConvert
+from img_convert import BaseConvert, search_qualities
+from result_store import EncodeResultStore, content_hash
+from encoder_registry import Encoder, register
+from temp_storage import temp_directory
+from resource_budget import available_cpus
+from tool_runner import synchronous
 
 source_dir = Path(__file__).resolve().parent
 
-tmp_root = r"a:"
-if os.path.exists(tmp_root):
-    tmp_dir = os.path.join(tmp_root, "tmp")
-else:
-    tmp_dir = None
-
+@register
 class FFMpegEnc(BaseConvert):
+    method = "ffmpeg"
+    encoders = [
+        Encoder("hevc_nvenc", "convert_to_hevc_nvenc", (51, 1), ".mkv", resource="gpu", threads=None),
+        Encoder("hevc", "convert_to_hevc", (51, 0), ".mkv", threads=0),
+        Encoder("av1", "convert_to_av1", (63, 1), ".mkv", threads=0),
+    ]
     ffmpeg_path = "ffmpeg"
-    threads = 4
+    threads = 4 # per ffmpeg process, CPU encoders run several segments at once
+    segment_time = 30 # seconds, segments are cut at the first keyframe after it
+    segment_jobs = None # concurrent segment encodes, None - CPU cores / threads
+    x265_preset = "medium"
+    svtav1_preset = 8
 
     def __init__(self, ffmpeg_path = None, threads=None, exif_path = None) -> None:
         super().__init__(exif_path)
@@ -25,30 +38,207 @@ class FFMpegEnc(BaseConvert):
         if threads is not None:
             self.threads = threads            
 
-    def convert_to_hevc_nvenc(self, in_file_name, out_file_name, quality):
+    async def convert_to_hevc_nvenc_async(self, in_file_name, out_file_name, quality):
         # quality - 0 (min) ... 100 (max) 
         # bin\ffmpeg_latest\ffmpeg -hide_banner -y -i videos\%file_name% -c:v hevc_nvenc -preset %preset%  -tune hq -profile:v main -b_ref_mode middle -nonref_p 1 -tier high -rc-lookahead 32 -rc vbr -bf 2 -cq %cq% -threads %NUMBER_OF_PROCESSORS% -c:a aac -q:a 2 output\res_latest_%preset%_%cq%_%file_name%
         out_file_name = self.norm_ext(out_file_name, [".mkv"])
         # -c:a aac -q:a 2
-        subprocess.check_output(f"{self.ffmpeg_path} -hide_banner -loglevel warning -stats -y -i {in_file_name} -c:v hevc_nvenc -preset p7  -tune hq -profile:v main -b_ref_mode middle -nonref_p 1 -tier high -rc-lookahead 32 -rc vbr -bf 2 -cq {quality} -threads {self.threads} -c:a copy {out_file_name}")
+        # -stats progress is passed through while the encode runs
+        await self.run_tool_async("ffmpeg", [
+            self.ffmpeg_path, "-hide_banner", "-loglevel", "warning", "-stats", "-y", "-i", in_file_name, "-c:v", "hevc_nvenc",
+            "-preset", "p7", "-tune", "hq", "-profile:v", "main", "-b_ref_mode", "middle", "-nonref_p", "1", "-tier", "high",
+            "-rc-lookahead", "32", "-rc", "vbr", "-bf", "2", "-cq", quality, "-threads", self.threads, "-c:a", "copy", out_file_name],
+            on_output=lambda name, text: sys.stderr.write(text))
         return out_file_name, os.path.getsize(out_file_name)
 
-    def get_function(self, format):
-        if format == "hevc_nvenc":
-            return self.convert_to_hevc_nvenc, (51, 1)
-        return None        
+    async def convert_to_hevc_async(self, in_file_name, out_file_name, quality):
+        # quality - 51 (min) ... 0 (max), libx265 crf
+        # threads 0 - no pools setting, x265 uses all cores (pools=0 would be no thread pool at all)
+        pools = f"pools={self.threads}:" if int(self.threads) else ""
+        return await self.convert_segmented_async(in_file_name, out_file_name, [
+            "-c:v", "libx265", "-preset", self.x265_preset, "-crf", str(quality),
+            "-x265-params", f"{pools}log-level=error"])
+
+    async def convert_to_av1_async(self, in_file_name, out_file_name, quality):
+        # quality - 63 (min) ... 1 (max), SVT-AV1 crf
+        return await self.convert_segmented_async(in_file_name, out_file_name, [
+            "-c:v", "libsvtav1", "-preset", str(self.svtav1_preset), "-crf", str(int(quality)),
+            "-svtav1-params", f"lp={self.threads}"])
+
+    async def ffmpeg_async(self, *args):
+        await self.run_tool_async("ffmpeg", [self.ffmpeg_path, "-hide_banner", "-loglevel", "error", "-y"] + list(args))
+
+    def settings_name(self, format):
+        preset = {"hevc_nvenc": "p7", "hevc": self.x265_preset, "av1": self.svtav1_preset}.get(format)
+        return f"{self.method}_{format}_{preset}"
+
+    def duration(self, in_file_name):
+        """
+        :return: duration in seconds from the ffmpeg input summary or None
+        """
+        res = self.run_tool("ffmpeg", [self.ffmpeg_path, "-hide_banner", "-i", in_file_name], check=False).stderr.decode(errors="replace")
+        found = re.search(r"Duration: (\d+):(\d+):(\d+\.?\d*)", res)
+        if found is None:
+            return None
+        hours, minutes, seconds = found.groups()
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    def sample(self, in_file_name, out_file_name, count = 3, seconds = 4):
+        """
+        Evenly spaced clips of the video stream, copied without re-encoding (cut at
+        keyframes) into one file. Bit exact muxing gives the same file every time, so
+        encode results of the sample stay in the result store.
+        """
+        duration = self.duration(in_file_name)
+        if duration is None or duration <= count * seconds:
+            self.ffmpeg("-i", in_file_name, "-map", "0:v:0", "-c", "copy", "-fflags", "+bitexact", out_file_name)
+            return out_file_name
+
+        directory = os.path.dirname(out_file_name)
+        clips = []
+        for i in range(count):
+            start = (duration - seconds) * (i + 0.5) / count
+            clips.append(os.path.join(directory, f"clip{i}.mkv"))
+            self.ffmpeg("-ss", f"{start:.3f}", "-i", in_file_name, "-t", str(seconds), "-map", "0:v:0", "-c", "copy",
+                        "-fflags", "+bitexact", clips[-1])
+        list_file_name = os.path.join(directory, "clips.txt")
+        with open(list_file_name, "w", encoding="utf-8") as list_file:
+            list_file.writelines("file '%s'\n" % os.path.basename(clip) for clip in clips)
+        self.ffmpeg("-f", "concat", "-safe", "0", "-i", list_file_name, "-c", "copy", "-fflags", "+bitexact", out_file_name)
+        for clip in clips:
+            os.remove(clip)
+        return out_file_name
+
+    def psnr(self, original_file_name, test_file_name):
+        res = self.run_tool("ffmpeg", [self.ffmpeg_path, "-hide_banner", "-i", test_file_name, "-i", original_file_name, "-lavfi",
+                                       "[0:v]settb=AVTB,setpts=PTS-STARTPTS[test];[1:v]settb=AVTB,setpts=PTS-STARTPTS[original];[test][original]psnr",
+                                       "-f", "null", "-"], check=False).stderr.decode(errors="replace")
+        found = re.findall(r"PSNR .*average:(\S+)", res)
+        if not found:
+            print("WARNING: psnr -", res[-500:])
+            return None
+        return float(found[-1])
+
+    async def convert_segmented_async(self, in_file_name, out_file_name, video_args):
+        """
+        Software encode in parallel segments: the video stream is split at keyframes
+        without re-encoding, segment_jobs ffmpeg processes encode the segments, and the
+        concat demuxer joins them with the source audio and subtitles copied.
+        """
+        out_file_name = self.norm_ext(out_file_name, [".mkv"])
+        # threads 0 - every ffmpeg uses all cores, so one segment at a time
+        jobs = self.segment_jobs or max(available_cpus() // (int(self.threads) or available_cpus()), 1)
+        with temp_directory(os.path.getsize(in_file_name) * 2) as tmpdirname:
+            segments = []
+            if jobs > 1:
+                await self.ffmpeg_async("-i", in_file_name, "-map", "0:v:0", "-c", "copy", "-f", "segment",
+                                        "-segment_time", str(self.segment_time), "-reset_timestamps", "1",
+                                        os.path.join(tmpdirname, "segment%05d.mkv"))
+                segments = sorted(glob.glob(os.path.join(tmpdirname, "segment*.mkv")))
+
+            if len(segments) <= 1:
+                await self.ffmpeg_async("-i", in_file_name, *video_args, "-threads", str(self.threads), "-c:a", "copy", out_file_name)
+                return out_file_name, os.path.getsize(out_file_name)
+
+            encoded = [segment[:-len(".mkv")] + "_encoded.mkv" for segment in segments]
+            semaphore = asyncio.Semaphore(jobs)
+
+            async def encode_segment(segment, result):
+                async with semaphore:
+                    await self.ffmpeg_async("-i", segment, *video_args, "-threads", str(self.threads), result)
+
+            # a failed segment cancels the others, their ffmpeg processes are killed
+            tasks = [asyncio.ensure_future(encode_segment(segment, result)) for segment, result in zip(segments, encoded)]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+
+            list_file_name = os.path.join(tmpdirname, "segments.txt")
+            with open(list_file_name, "w", encoding="utf-8") as list_file:
+                list_file.writelines("file '%s'\n" % os.path.basename(result) for result in encoded)
+            await self.ffmpeg_async("-f", "concat", "-safe", "0", "-i", list_file_name, "-i", in_file_name,
+                                    "-map", "0:v", "-map", "1:a?", "-map", "1:s?", "-c", "copy", out_file_name)
+        return out_file_name, os.path.getsize(out_file_name)
+
+    convert_to_hevc_nvenc = synchronous(convert_to_hevc_nvenc_async)
+    convert_to_hevc = synchronous(convert_to_hevc_async)
+    convert_to_av1 = synchronous(convert_to_av1_async)
+    convert_segmented = synchronous(convert_segmented_async)
+    ffmpeg = synchronous(ffmpeg_async)
+
+def search_quality_psnr(method_format_name, convert, psnr, if_file_name, min_q, max_q, target_psnr, store=None):
+    """
+    Lowest quality setting with PSNR >= target_psnr, by bisection; encodes and PSNR
+    values are kept in the result store.
+    """
+    if store is None:
+        store = EncodeResultStore()
+    source_hash = content_hash(if_file_name)
+    input_file_size = os.path.getsize(if_file_name)
+    result = max_q
+    with temp_directory(input_file_size) as tmpdirname:
+        low_q, high_q = min_q, max_q
+        while abs(high_q - low_q) > 1:
+            q = (low_q + high_q) // 2
+            stored = store.get(source_hash, method_format_name, q)
+            cached = stored is not None and stored["psnr"] is not None
+            if cached:
+                value = stored["psnr"]
+            else:
+                encode_start = time.time()
+                output_file_name, output_size = convert(if_file_name, os.path.join(tmpdirname, "tmp"), q)
+                encode_time = time.time() - encode_start
+                value = psnr(if_file_name, output_file_name)
+                store.put(source_hash, method_format_name, q, output_size, encode_time, value, input_file_size)
+            print(f"psnr({q}) = {value}{', cached' if cached else ''}")
+            if value is not None and value >= target_psnr:
+                result = high_q = q
+            else:
+                low_q = q
+    return result
+
+
+def optimize_video(converter, format, in_file_name, target_ratios = (), target_psnr = None, store = None, count = 3, seconds = 4):
+    """
+    Per-title quality from a few short sample clips instead of the whole video.
+
+    Ratios are of the sample video stream, audio is not counted.
+    :return: dict(target ratio: quality), with key "psnr" for target_psnr
+    """
+    convert, q_range = converter.get_function(format)
+    if convert is None:
+        raise ValueError(f"Unknown format - {format}")
+    method_format_name = converter.settings_name(format)
+    with temp_directory(os.path.getsize(in_file_name) // 10) as tmpdirname:
+        sample_file_name = converter.sample(in_file_name, os.path.join(tmpdirname, "sample.mkv"), count, seconds)
+        result = {}
+        if target_ratios:
+            result = search_qualities(method_format_name, convert, sample_file_name, q_range[0], q_range[1], target_ratios, store)
+        if target_psnr is not None:
+            result["psnr"] = search_quality_psnr(method_format_name, convert, converter.psnr, sample_file_name,
+                                                 q_range[0], q_range[1], target_psnr, store)
+    return result
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("method", choices=["ffmpeg"], help="ffmpeg")
-    parser.add_argument("-f", "--format", default=None, help="""For 'ffmpeg' method - hevc_nvenc;""")
+    parser.add_argument("-f", "--format", default=None, help="""For 'ffmpeg' method - hevc_nvenc, hevc (libx265), av1 (SVT-AV1);""")
     parser.add_argument("-i", "--input_file", default=None, help="Input file name with path")
     parser.add_argument("-o", "--output_file", default="result", help="Output file name with path with or without extention")
     parser.add_argument("-q", "--quality_level", default=28, help="Quality of encoding")
     # parser.add_argument("-c", "--codec", choices=["aom", "rav1e"], default="aom", help="Optional codec selection for 'avifenc' method - aom, rav1e")
     # parser.add_argument("-s", "--speed", choices=list(map(str, range(0, 11))), default="6", help="Optional speed selection for 'avifenc' method - integer value in [0..10], 0 is slowest and 10 is fastest")
     # parser.add_argument("-t", "--threads", choices=list(map(str, range(0, 33))), default="8", help="Number of parallel CPU threads for 'avifenc' method - integer value in [0..32]")
-    # parser.add_argument("--optimize", default=None, help="Find a quality value for 2, 3, 4 ratios")
+    parser.add_argument("--optimize", default=None, help="Find quality values for these comma separated ratios (e.g. 2,3,4) on sample clips")
+    parser.add_argument("--target_psnr", type=float, default=None, help="With --optimize: also find the lowest quality with at least this PSNR")
+    parser.add_argument("--samples", type=int, default=3, help="Number of sample clips for --optimize")
+    parser.add_argument("--sample_seconds", type=float, default=4, help="Length of one sample clip in seconds")
+    parser.add_argument("--cache_file", default="cache.db", help="Encode result store used by --optimize")
     return parser.parse_args()
 
 if __name__ == "__main__":
@@ -62,12 +252,20 @@ if __name__ == "__main__":
 
     # format_name = args.format
     if args.method == "ffmpeg":
-        converter = FFMpegEnc(ffmpeg_path, exiftool_path)
+        converter = FFMpegEnc(ffmpeg_path, exif_path=exiftool_path)
 
     if converter is None:
         print(f"Unknown method - {args.method}")
         exit(1)
 
+    if args.optimize is not None or args.target_psnr is not None:
+        ratios = [float(ratio) for ratio in args.optimize.split(",")] if args.optimize else []
+        store = EncodeResultStore(args.cache_file)
+        for target, q in optimize_video(converter, args.format, args.input_file, ratios, args.target_psnr, store,
+                                        args.samples, args.sample_seconds).items():
+            print(f"q for {'psnr ' + str(args.target_psnr) if target == 'psnr' else 'ratio ' + str(target)} is {q}")
+        exit(0)
+
     input_file_size = os.path.getsize(args.input_file)
     converter_function, q_range = converter.get_function(args.format)
     if converter_function is None:
@@ -0,0 +1,222 @@
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+
+import change_detection
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+watch_mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+event_header = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """
+    Changed files of a tree from Linux inotify, through ctypes.
+
+    Every directory gets a watch; a file is reported when it is closed after writing or
+    moved in, a new directory is watched and all files in it are reported. read()
+    returns None if the kernel queue overflowed or a watched root went away - events
+    were lost and the caller has to scan the whole tree.
+    """
+    name = "inotify"
+
+    def __init__(self, source) -> None:
+        self.source = source
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1: " + os.strerror(ctypes.get_errno()))
+        self.directories = {} # watch descriptor: relative directory
+        try:
+            self.add_tree("")
+        except OSError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def add_directory(self, relative_directory):
+        path = os.fsencode(os.path.join(self.source, relative_directory))
+        wd = self.libc.inotify_add_watch(self.fd, path, watch_mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            # ENOSPC - fs.inotify.max_user_watches is too low for the tree
+            raise OSError(errno, "inotify_add_watch: %s %s" % (os.strerror(errno), os.fsdecode(path)))
+        self.directories[wd] = relative_directory
+
+    def add_tree(self, relative_directory):
+        """
+        Watch a directory and its subdirectories.
+
+        :return: relative paths of the files already in them
+        """
+        files = []
+        for directory, entries in change_detection.scan_tree(os.path.join(self.source, relative_directory)):
+            directory = os.path.normpath(os.path.join(relative_directory, directory)) if relative_directory or directory else ""
+            try:
+                self.add_directory(directory)
+            except FileNotFoundError:
+                continue
+            files += [os.path.join(directory, name) for name, stat in entries]
+        return files
+
+    def read(self, timeout = None):
+        """
+        :return: changed relative paths within timeout seconds, None - events were lost
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        changed = []
+        lost = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = event_header.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + event_header.size:offset + event_header.size + length].rstrip(b"\0"))
+                offset += event_header.size + length
+                if mask & IN_Q_OVERFLOW:
+                    lost = True
+                    continue
+                directory = self.directories.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.directories[wd]
+                    lost = lost or directory == ""
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    lost = lost or directory == ""
+                    continue
+                relative_path = os.path.join(directory, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        try:
+                            changed += self.add_tree(relative_path)
+                        except OSError as e:
+                            print("WARNING: inotify -", e)
+                            lost = True
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    changed.append(relative_path)
+        return None if lost else changed
+
+
+class PollingWatcher:
+    """
+    Changed files of a tree from a scandir walk every interval seconds, where inotify
+    does not exist (Windows, network shares) or has too few watches.
+    """
+    name = "polling"
+    interval = 60.0
+
+    def __init__(self, source, interval = None) -> None:
+        self.source = source
+        if interval is not None:
+            self.interval = interval
+        self.snapshot = self.scan()
+        self.last_scan = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def close(self):
+        pass
+
+    def scan(self):
+        snapshot = {}
+        for relative_directory, files in change_detection.scan_tree(self.source):
+            for name, stat in files:
+                snapshot[os.path.join(relative_directory, name)] = (stat.st_size, stat.st_mtime)
+        return snapshot
+
+    def read(self, timeout = None):
+        """
+        :return: paths new or changed since the last scan, [] before the next scan is due
+        """
+        wait = self.last_scan + self.interval - time.time()
+        if wait > 0:
+            if timeout is not None and timeout < wait:
+                time.sleep(timeout)
+                return []
+            time.sleep(wait)
+        snapshot = self.scan()
+        self.last_scan = time.time()
+        changed = [path for path, value in snapshot.items() if self.snapshot.get(path) != value]
+        self.snapshot = snapshot
+        return changed
+
+
+def get_watcher(source, poll_interval = None):
+    try:
+        return InotifyWatcher(source)
+    except (OSError, AttributeError) as e:
+        # AttributeError - no inotify_init1 in the C library
+        print("WARNING: inotify -", e, "- polling every %.0f s" % (poll_interval or PollingWatcher.interval))
+        return PollingWatcher(source, poll_interval)
+
+
+class Debouncer:
+    """
+    Changed paths wait until no event came for them for delay seconds, so a file that
+    is still being copied is backed up once, after the copy.
+    """
+
+    def __init__(self, delay) -> None:
+        self.delay = delay
+        self.pending = {}
+
+    def add(self, paths):
+        now = time.time()
+        for path in paths:
+            self.pending[path] = now
+
+    def ready(self):
+        """
+        :return: sorted paths quiet for delay seconds, removed from the queue
+        """
+        now = time.time()
+        paths = [path for path, last_event in self.pending.items() if now - last_event >= self.delay]
+        for path in paths:
+            del self.pending[path]
+        return sorted(paths, key=lambda path: (os.path.dirname(path), path))
+
+    def timeout(self):
+        """
+        :return: seconds until the next path is ready, None if nothing is queued
+        """
+        if not self.pending:
+            return None
+        return max(min(self.pending.values()) + self.delay - time.time(), 0)
+
+    def clear(self):
+        self.pending = {}